@@ -2,4 +2,41 @@
 
 __all__ = ['ipsy']
 
-from .ipsy import *
+from importlib import import_module
+
+# Submodules are imported the first time one of their names is used, so
+# running the CLI only imports what the chosen subcommand needs. The names
+# are listed here so looking one up, or a name that doesn't exist, imports
+# nothing else; a name in two modules comes from the first.
+_EXPORTS = {
+    'ipsy': ('RECORD_HEADER_SIZE', 'RECORD_OFFSET_SIZE', 'RECORD_SIZE_SIZE', 'RECORD_RLE_DATA_SIZE',
+             'MIN_PATCH', 'MIN_RECORD', 'MIN_COMPRESS', 'MAX_UNPATCHED', 'MAX_RECORD_SIZE', 'EOF_OFFSET',
+             'IPS32_HEADER', 'IPS32_FOOTER', 'IPS32_OFFSET_SIZE', 'MAX_UNPATCHED_IPS32', 'EEOF_OFFSET',
+             'DIFF_BLOCK_SIZE', 'DIFF_SUB_BLOCK_SIZE', 'DIFF_STREAM_WINDOW', 'LITERAL_COST', 'RLE_COST',
+             'MAX_BRIDGE', 'LITERAL_COST_32', 'RLE_COST_32', 'WRITE_BATCH', 'DIFF_TASKS_PER_WORKER',
+             'HASH_BLOCK_SIZE', 'HASH_DIGEST_SIZE', 'HASH_SUFFIX', 'HASH_MAGIC', 'PATCH_FORMATS',
+             'IpsRecord', 'PatchResult', 'IpsyError', 'IpsOverlay', 'RecordTable', 'patch_format',
+             'write', 'read', 'iter_records', 'merge', 'cleanup_records', 'rle_compress', 'encode',
+             'block_hashes', 'diff', 'diff_stream', 'patch_from_records', 'patch', 'patch_many'),
+    'bps': ('BPS_MAGIC', 'BpsHeader', 'bps_header', 'bps_patch', 'bps_diff'),
+    'ups': ('UPS_MAGIC', 'UpsHeader', 'UpsRecord', 'ups_header', 'iter_ups_records', 'ups_patch', 'ups_diff'),
+    'cache': ('CACHE_MAX_SIZE', 'ROM_CACHE_SIZE', 'ResultCache', 'RomCache'),
+    'stats': ('Stats', 'collect_stats', 'current_stats'),
+    'index': ('INDEX_SUFFIX', 'PatchIndex'),
+    'conflict': ('Overlap', 'find_overlaps'),
+    'batch': ('BatchResult', 'read_manifest', 'run_batch'),
+    'checksum': ('VERIFY_ALGORITHMS', 'VERIFY_CHUNK_SIZE', 'verify'),
+    'server': ('SERVER_CACHE_SIZE', 'SERVER_MAX_CONNECTIONS', 'RomCache', 'PatchServer', 'serve'),
+}
+_NAMES = {name: module for module, names in reversed(list(_EXPORTS.items())) for name in names}
+
+def __getattr__( name ):
+    if name in _EXPORTS:
+        return import_module('.' + name, __name__)
+    if name not in _NAMES:
+        raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+    value = globals()[name] = getattr(import_module('.' + _NAMES[name], __name__), name)
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS) | set(_NAMES))
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-from os.path import splitext, getsize, basename
+from os.path import splitext, getsize, basename, isfile, exists, samefile
+from os import remove
 from shutil import copyfile
-from sys import argv
-from .ipsy import MIN_PATCH, MAX_UNPATCHED, patch, diff, merge
+from sys import argv, exit, stderr
+
+# Everything else is imported by the subcommand that needs it, so startup
+# stays cheap for --version and one-off runs.
 
 def parse_args():
     parser = ArgumentParser(description=
-        'Apply an IPS patch, Diff two files to generate a patch, or Merge multiple IPS files.',
+        'Apply an IPS, BPS or UPS patch, Diff two files to generate a patch, or Merge multiple IPS files.',
         prog='ipsy')
     parser.add_argument('-v','--version', action='version', version='%(prog)s 0.3')
     subparsers = parser.add_subparsers(dest='option', help=
@@ -19,20 +22,50 @@ def parse_args():
     parser_patch.add_argument('unpatched', help=
         'The unpatched file. ')
     parser_patch.add_argument('patch', nargs='+', help=
-        'IPS file(s) to apply to the target. Each file will create its own rom.')
+        'IPS, IPS32, BPS or UPS file(s) to apply to the target. Each file will create its own rom.')
     parser_patch.add_argument('-eof', action='store_true', help=
         'Ignore "EOF" markers unless they are actually found at the end of the file.')
+    parser_patch.add_argument('-nomap', action='store_true', help=
+        'Write records one at a time instead of memory mapping the new ROM.')
+    parser_patch.add_argument('-stack', action='store_true', help=
+        'Apply all of the patches, in order, to a single new file.')
+    parser_patch.add_argument('-m','--merged', default=None, help=
+        'With -stack, also save the stacked patches as one IPS file.')
+    parser_patch.add_argument('-u','--undo', default=None, help=
+        'Also save an IPS file that undoes the patch, or the stacked patches, on the new ROM.')
+    parser_patch.add_argument('-j','--jobs', type=int, default=1, help=
+        'Number of processes used to apply several patches at once.')
+    parser_patch.add_argument('--cache-dir', default=None, help=
+        'Directory to reuse results from, and store them to, keyed by the content of the inputs.')
+    parser_patch.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help=
+        'Print the time spent in each stage and counts of the work done to stderr, as text or JSON.')
     parser_patch.add_argument('-o','--output', default=None, help=
         'Name for the new ROM file.')
 
     parser_diff = subparsers.add_parser('diff', help=
-        'Generate an IPS file by diffing the original and modified versions.')
+        'Generate an IPS (IPS32 past 16 MiB, or BPS, UPS) file by diffing the original and modified versions.')
     parser_diff.add_argument('unpatched', help=
         'The orignal or unpatched file.')
     parser_diff.add_argument('patched', help=
         'The modified or already patched file.')
     parser_diff.add_argument('-norle', action='store_true', help=
         "Do not attempt to compress the patch via run length encoding.")
+    parser_diff.add_argument('-bps', action='store_true', help=
+        "Create a BPS patch, the files may then differ in size.")
+    parser_diff.add_argument('-block', type=int, default=None, help=
+        "With -bps, size of the pieces matched (32 by default). Smaller is slower but gives smaller patches.")
+    parser_diff.add_argument('-ups', action='store_true', help=
+        "Create a UPS patch, the files may then differ in size.")
+    parser_diff.add_argument('-ips32', action='store_true', help=
+        "Create an IPS32 patch even if the patched file is under 16 MiB. Piped files switch to IPS32 when they need it.")
+    parser_diff.add_argument('-hashed', action='store_true', help=
+        "Only compare blocks whose hashes differ, caching the unpatched file's hashes next to it.")
+    parser_diff.add_argument('-j','--jobs', type=int, default=1, help=
+        'Number of processes used to diff an IPS patch, 0 for one per core.')
+    parser_diff.add_argument('--cache-dir', default=None, help=
+        'Directory to reuse results from, and store them to, keyed by the content of the inputs.')
+    parser_diff.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help=
+        'Print the time spent in each stage and counts of the work done to stderr, as text or JSON.')
     parser_diff.add_argument('-o','--output', default=None, help=
         'Name for the new IPS file.')
 
@@ -43,58 +76,340 @@ def parse_args():
         'Providing this can greatly reduce the size of the resulting patch.')
     parser_merge.add_argument('patch', nargs='+', help=
         'List of IPS files to merge.')
+    parser_merge.add_argument('--cache-dir', default=None, help=
+        'Directory to reuse results from, and store them to, keyed by the content of the inputs.')
+    parser_merge.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help=
+        'Print the time spent in each stage and counts of the work done to stderr, as text or JSON.')
     parser_merge.add_argument('-o','--output', default=None, help=
         'Name for the merged IPS file.')
         
+    parser_conflicts = subparsers.add_parser('conflicts', help=
+        'List the ranges written by more than one IPS file, as JSON.')
+    parser_conflicts.add_argument('patch', nargs='+', help=
+        'List of IPS files to check against one another.')
+    parser_conflicts.add_argument('-eof', action='store_true', help=
+        'Ignore "EOF" markers unless they are actually found at the end of the file.')
+    parser_conflicts.add_argument('-compare', action='store_true', help=
+        'Compare the bytes written, so overlaps that write the same bytes can be told apart.')
+    parser_conflicts.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help=
+        'Print the time spent in each stage and counts of the work done to stderr, as text or JSON.')
+    parser_conflicts.add_argument('-o','--output', default=None, help=
+        'Name for the JSON file, printed if not given.')
+
+    parser_verify = subparsers.add_parser('verify', help=
+        'Print the checksum of the file each patch would produce, without writing it.')
+    parser_verify.add_argument('unpatched', help=
+        'The unpatched file, read once for all of the patches. "-" reads it from stdin.')
+    parser_verify.add_argument('patch', nargs='+', help=
+        'IPS, IPS32, BPS or UPS file(s) to check.')
+    parser_verify.add_argument('-hash', default='crc32', choices=['crc32', 'md5', 'sha1'], help=
+        'Checksum to compute.')
+    parser_verify.add_argument('-expect', nargs='+', default=None, help=
+        'Checksums the patched files should have, one per patch, in hex.')
+    parser_verify.add_argument('-eof', action='store_true', help=
+        'Ignore "EOF" markers unless they are actually found at the end of the file.')
+    parser_verify.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help=
+        'Print the time spent in each stage and counts of the work done to stderr, as text or JSON.')
+
+    parser_serve = subparsers.add_parser('serve', help=
+        'Serve patch requests over HTTP, keeping base ROMs in memory between requests.')
+    parser_serve.add_argument('roms', help=
+        'Directory holding the base ROMs that requests may name.')
+    parser_serve.add_argument('-host', default='127.0.0.1', help=
+        'Address to listen on.')
+    parser_serve.add_argument('-port', type=int, default=8000, help=
+        'Port to listen on.')
+    parser_serve.add_argument('-socket', default=None, help=
+        'Listen on this Unix socket instead of a port.')
+    parser_serve.add_argument('-j','--jobs', type=int, default=0, help=
+        'Number of threads applying patches, 0 for one per core.')
+    parser_serve.add_argument('-cache', type=int, default=None, help=
+        'Bytes of base ROMs to keep in memory (256 MiB by default).')
+    parser_serve.add_argument('-max-requests', type=int, default=None, help=
+        'Patches applied at once, the number of threads by default. Others wait their turn.')
+    parser_serve.add_argument('-max-pending', type=int, default=None, help=
+        'Requests waiting or running before new ones are refused (64 by default).')
+    parser_serve.add_argument('-max-connections', type=int, default=None, help=
+        'Connections open at once before new ones are refused (256 by default).')
+
+    parser_batch = subparsers.add_parser('batch', help=
+        'Run the patch, diff and merge jobs of a JSON or JSONL manifest in one process.')
+    parser_batch.add_argument('manifest', help=
+        'JSON list of jobs, or JSONL with one job per line. "-" reads it from stdin.')
+    parser_batch.add_argument('-j','--jobs', type=int, default=1, help=
+        'Number of processes to run the jobs in, 0 for one per core.')
+    parser_batch.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help=
+        'Print the time spent in each stage and counts of the work done to stderr, as text or JSON.')
+    parser_batch.add_argument('-o','--output', default=None, help=
+        'Name for the JSONL file of results, printed as each job finishes if not given.')
+
     return parser.parse_args()
 
 def main():
-    argv += ['-h'] if len(argv) < 3 else []
+    argv.extend(['-h'] if len(argv) < 3 else [])
     opts = parse_args()
+    cache = None
+    if getattr(opts, 'cache_dir', None):
+        from .cache import ResultCache
+        cache = ResultCache(opts.cache_dir)
+    try:
+        if getattr(opts, 'stats', None):
+            from .stats import collect_stats
+            with collect_stats() as stats:
+                try:
+                    run(opts, cache)
+                finally:
+                    # stdout may be the command's own output, e.g. the conflicts report
+                    print(stats.to_json() if opts.stats == 'json' else stats, file=stderr)
+        else:
+            run(opts, cache)
+    finally:
+        if cache is not None:
+            stats = cache.stats()
+            print("Cache: " + str(stats['hits']) + " hits, " + str(stats['misses']) + " misses.")
+
+def cached( cache, key, path_out, produce ):
+    '''
+    Copy a result out of the cache, or produce it and store it.
+
+    :returns: Count returned by produce, or stored with the result
+    '''
+    count = cache.get_file( key, path_out ) if cache is not None else None
+    if count is None:
+        count = produce()
+        if cache is not None:
+            cache.put( key, path_out, count )
+    return count
 
+def output_name( path_unpatched, path_patch=None ):
+    '''
+    Default name of a patched file, next to the unpatched one. 'game.rom'
+    gives 'game_patched.rom', or 'game_fix_patched.rom' with patch 'fix.ips'
+    when each of several patches makes its own file.
+    '''
+    stem, ext = splitext(path_unpatched)
+    if path_patch is not None:
+        stem += '_' + splitext(basename(path_patch))[0]
+    return stem + '_patched' + ext
+
+def refuse_overwrite( path_output, paths_input ):
+    '''
+    Raise if path_output is the same file as any of paths_input, which
+    writing it would destroy.
+    '''
+    if not exists(path_output):
+        return
+    for path_input in paths_input:
+        if exists(path_input) and samefile(path_output, path_input):
+            raise IOError("Output " + path_output + " is the same file as input " + path_input)
+
+def run( opts, cache ):
     if opts.option == 'patch':
-        if getsize(opts.patch[0]) < MIN_PATCH:
-            raise IOError("Patch is too small to be valid")
-        if getsize(opts.unpatched) > MAX_UNPATCHED:
+        from .ipsy import MIN_PATCH, MAX_UNPATCHED, MAX_UNPATCHED_IPS32, patch, patch_many, patch_format
+        for ips_file in opts.patch:
+            if getsize(ips_file) < MIN_PATCH:
+                raise IOError("Patch " + ips_file + " is too small to be valid")
+        formats = []
+        for ips_file in opts.patch:
+            with open(ips_file, 'rb') as fh:
+                formats.append(patch_format( fh ))
+        if 'ips' in formats and getsize(opts.unpatched) > MAX_UNPATCHED:
             raise IOError("IPS can only patch files under 2^24 bytes")
-        if (len(opts.unpatched) == 1) and opts.output:
-            rom_names = [opts.output]
-            copyfile(opts.unpatched[0], opts.output)
+        if 'ips32' in formats and getsize(opts.unpatched) > MAX_UNPATCHED_IPS32:
+            raise IOError("IPS32 can only patch files under 2^32 bytes")
+        if opts.stack and any(fmt not in ('ips', 'ips32') for fmt in formats):
+            raise IOError("Only IPS patches can be stacked")
+        if opts.undo and len(opts.patch) > 1 and not opts.stack:
+            raise IOError("An undo patch can only be saved for one patch, or with -stack")
+        if opts.undo and any(fmt not in ('ips', 'ips32') for fmt in formats):
+            raise IOError("An undo patch can only be saved for IPS patches")
+        if opts.stack or opts.undo:
+            rom_file = opts.output or output_name( opts.unpatched )
+            for path_output in [rom_file, opts.merged, opts.undo]:
+                if path_output:
+                    refuse_overwrite( path_output, [opts.unpatched] + opts.patch )
+            copyfile( opts.unpatched, rom_file )
+            fhips, fhmerged, fhundo = [], None, None
+            try:
+                fhips = [open(ips_file, 'rb') for ips_file in opts.patch]
+                fhmerged = open(opts.merged, 'wb') if opts.stack and opts.merged else None
+                fhundo = open(opts.undo, 'wb') if opts.undo else None
+                with open(rom_file, 'r+b') as fhdst:
+                    numb = patch( fhdst, fhips if opts.stack else fhips[0], opts.eof, not opts.nomap,
+                                  fhmerged, fhundo )
+            finally:
+                _ = [fh.close() for fh in fhips + [fhmerged, fhundo] if fh]
+            if opts.stack:
+                print("Applied " + str(len(opts.patch)) + " patches in " + str(numb) + " writes.")
+            else:
+                print("Applied " + str(numb) + " records from patch " + basename(opts.patch[0]) + ".")
+            if opts.undo:
+                print("Saved undo patch, " + str(getsize(opts.undo)) + " bytes.")
+            return
+        if len(opts.patch) == 1:
+            rom_names = [opts.output or output_name( opts.unpatched )]
         else:
-            rom_names = [splitext(patch)[0] + splittext(opts.unpatched)[-1] for patch in opts.patch]
-            _ = [copyfile( opts.unpatched, rom_file ) for rom_file in rom_names]
-        try:
-            fhdst = [open( fn, 'r+b') for fn in rom_names]
-            fhips = [open( fn, 'rb') for fn in opts.patch]
-            for n,fh in enumerate(fhips):
-                numb = patch( fhdest, fh )
-                print("Applied " + str(numb) + " records from patch " + basename(opts.patch[n]))
-        finally:
-            _ = [file.close() for file in fhips]
-            _ = [file.close() for file in fhdst]
+            rom_names = [output_name( opts.unpatched, ips_file ) for ips_file in opts.patch]
+        if len(set(rom_names)) < len(rom_names):
+            raise IOError("Patches with the same name would write the same file")
+        for rom_file in rom_names:
+            refuse_overwrite( rom_file, [opts.unpatched] + opts.patch )
+        results = patch_many( opts.unpatched, zip(opts.patch, rom_names), opts.eof,
+                              mapped=not opts.nomap, workers=opts.jobs, cache=cache )
+        for result in results:
+            if result.error:
+                print("Failed to apply patch " + basename(result.patch) + ": " + str(result.error))
+            else:
+                print("Applied " + str(result.records) + " records from patch " + \
+                    basename(result.patch) + " in " + "{:.3f}".format(result.seconds) + "s")
+        if any(result.error for result in results):
+            exit(1)
 
-    if opts.option == 'diff':
-        if getsize(opts.unpatched) != getsize(opts.patched):
+    if opts.option == 'diff' and opts.bps:
+        from .bps import BPS_BLOCK_SIZE, bps_diff
+        block = opts.block or BPS_BLOCK_SIZE
+        patchfile = opts.output if opts.output else splitext(opts.patched)[0] + "_patch.bps"
+        def produce():
+            with open(opts.unpatched,'rb') as fhsrc, open(opts.patched,'rb') as fhdst,\
+            open(patchfile,'wb') as fhpatch:
+                return bps_diff( fhsrc, fhdst, fhpatch, block )
+        key = cache and cache.key('bps_diff', [cache.digest( opts.unpatched ),
+            cache.digest( opts.patched )], block=block)
+        actions = cached( cache, key, patchfile, produce )
+        print("Patch created, " + str(getsize(patchfile)) + " bytes, " + \
+            str(actions) + " actions.")
+
+    elif opts.option == 'diff' and opts.ups:
+        from .ups import ups_diff
+        patchfile = opts.output if opts.output else splitext(opts.patched)[0] + "_patch.ups"
+        def produce():
+            with open(opts.unpatched,'rb') as fhsrc, open(opts.patched,'rb') as fhdst,\
+            open(patchfile,'wb') as fhpatch:
+                return ups_diff( fhsrc, fhdst, fhpatch )
+        key = cache and cache.key('ups_diff', [cache.digest( opts.unpatched ),
+            cache.digest( opts.patched )])
+        hunks = cached( cache, key, patchfile, produce )
+        print("Patch created, " + str(getsize(patchfile)) + " bytes, " + \
+            str(hunks) + " hunks.")
+
+    elif opts.option == 'diff':
+        from .ipsy import MAX_UNPATCHED_IPS32, IpsyError, diff, diff_stream, write
+        streamed = not (isfile(opts.unpatched) and isfile(opts.patched))
+        if not streamed and getsize(opts.unpatched) != getsize(opts.patched):
             raise IOError("The two files are of differing size")
+        if not streamed and getsize(opts.patched) > MAX_UNPATCHED_IPS32:
+            raise IOError("IPS32 can only patch files under 2^32 bytes")
         patchfile = opts.output if opts.output else splitext(opts.patched)[0] + "_patch.ips"
-        with open(opts.unpatched,'rb') as fhsrc, open(opts.patched,'rb') as fhdst,\
-        open(patchfile,'wb') as fhpatch:
-            records = diff( fhsrc, fhdst, fhpatch, not opts.norle )
-        print("Patch created, " + str(getsize(patchfile)) + " bytes, " + \
-            str(len(records)) + " records.")
+        try:
+            with open(opts.unpatched,'rb') as fhsrc, open(opts.patched,'rb') as fhdst,\
+            open(patchfile,'w+b') as fhpatch:
+                if streamed:
+                    # Pipes are diffed as they are read, the records go straight to the patch,
+                    # which is rewritten as IPS32 if a record turns out to need it
+                    write( fhpatch, diff_stream( fhsrc, fhdst, not opts.norle ), opts.ips32 or None )
+                else:
+                    records = diff( fhsrc, fhdst, fhpatch, not opts.norle, workers=opts.jobs or None,
+                                    hashed=opts.hashed, cache=cache, ips32=opts.ips32 or None )
+        except IpsyError as e:
+            if not streamed:
+                raise
+            remove(patchfile)
+            print("Failed to create patch: " + str(e) + ".")
+            exit(1)
+        if streamed:
+            print("Patch created, " + str(getsize(patchfile)) + " bytes.")
+        else:
+            print("Patch created, " + str(getsize(patchfile)) + " bytes, " + \
+                str(len(records)) + " records.")
 
     if opts.option == 'merge':
+        from .ipsy import MIN_PATCH, merge
         for ips_file in opts.patch:
             if getsize(ips_file) < MIN_PATCH:
                 raise IOError("Patch " + ips_file + " is too small to be valid")
         patchfile = opts.output if opts.output else splitext(opts.patch[0])[0] + '_merged.ips'
+        fhips = []
         try:
             fhips = [open(ips_file, 'rb') for ips_file in opts.patch]
             with open( patchfile, 'w+b' ) as fhdst:
-                merge( fhdst, *fhips, opts.destination )
+                merge( fhdst, *fhips, path_dst=opts.destination, cache=cache )
         finally:
             _ = [ips_file.close() for ips_file in fhips]
         print("Merged " + str( len(opts.patch) ) + " IPS files into one.")
 
+    if opts.option == 'conflicts':
+        from .conflict import find_overlaps
+        import json
+        overlaps = find_overlaps( opts.patch, opts.eof, opts.compare )
+        report = json.dumps([{'first': opts.patch[o.first], 'second': opts.patch[o.second],
+            'start': o.start, 'end': o.end, 'identical': o.identical} for o in overlaps], indent=1)
+        if opts.output:
+            with open(opts.output, 'w') as fh:
+                fh.write(report)
+            if opts.compare:
+                conflicting = sum(1 for o in overlaps if not o.identical)
+                print("Found " + str(len(overlaps)) + " overlaps, " + str(conflicting) + " conflicting.")
+            else:
+                print("Found " + str(len(overlaps)) + " overlaps.")
+        else:
+            print(report)
+
+    if opts.option == 'verify':
+        from .checksum import verify
+        from sys import stdin
+        if opts.expect and len(opts.expect) != len(opts.patch):
+            raise IOError("Give one expected checksum per patch")
+        fhips = []
+        try:
+            fhips = [open(ips_file, 'rb') for ips_file in opts.patch]
+            if opts.unpatched == '-':
+                digests = verify( stdin.buffer, fhips, opts.hash, opts.eof )
+            else:
+                with open(opts.unpatched, 'rb') as fhsrc:
+                    digests = verify( fhsrc, fhips, opts.hash, opts.eof )
+        finally:
+            _ = [ips_file.close() for ips_file in fhips]
+        mismatched = 0
+        for i, digest in enumerate(digests):
+            if opts.expect and opts.expect[i].lower() != digest:
+                mismatched += 1
+                print(basename(opts.patch[i]) + ": " + digest + " expected " + opts.expect[i].lower())
+            else:
+                print(basename(opts.patch[i]) + ": " + digest)
+        if mismatched:
+            exit(1)
+
+    if opts.option == 'serve':
+        from .server import SERVER_CACHE_SIZE, SERVER_MAX_PENDING, SERVER_MAX_CONNECTIONS, serve
+        print("Serving " + opts.roms + " on " + (opts.socket or opts.host + ":" + str(opts.port)) + ".")
+        serve( opts.roms, opts.host, opts.port, opts.socket, workers=opts.jobs or None,
+               cache_size=opts.cache or SERVER_CACHE_SIZE, max_requests=opts.max_requests,
+               max_pending=opts.max_pending or SERVER_MAX_PENDING,
+               max_connections=opts.max_connections or SERVER_MAX_CONNECTIONS )
+
+    if opts.option == 'batch':
+        from .batch import read_manifest, run_batch
+        from sys import stdin, stdout
+        import json
+        if opts.manifest == '-':
+            jobs = read_manifest( stdin )
+        else:
+            with open(opts.manifest) as fh:
+                jobs = read_manifest( fh )
+        fhout = open(opts.output, 'w') if opts.output else stdout
+        failed = 0
+        try:
+            for result in run_batch( jobs, opts.jobs or None ):
+                fhout.write(json.dumps(result._asdict()) + '\n')
+                fhout.flush()
+                failed += result.error is not None
+        finally:
+            if opts.output:
+                fhout.close()
+        if opts.output:
+            print("Ran " + str(len(jobs)) + " jobs, " + str(failed) + " failed.")
+        if failed:
+            exit(1)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from io import BytesIO
+from os.path import getsize
+from time import perf_counter
+import json
+from .ipsy import IpsyError, read, diff, merge, patch, patch_format, _patch_buffered
+from .cache import RomCache
+
+__all__ = ['BatchResult', 'read_manifest', 'run_batch']
+
+class BatchResult( namedtuple('BatchResult', 'id op output records seconds error') ):
+    '''
+    Outcome of one job run by :func:`run_batch`.
+
+    :param id: The job's 'id', or its position in the manifest
+    :param op: 'patch', 'diff' or 'merge'
+    :param output: Path of the file written
+    :param records: Number of records (or actions, hunks) in the result, for
+                    merge the number of patches merged
+    :param seconds: Wall time spent on this job
+    :param error: Message of the exception raised by the job, None on success
+    '''
+    pass
+
+_bases = RomCache() # Unpatched files read by this process
+
+def _base( path ):
+    '''
+    Contents of an unpatched file, shared by every job that uses it. Read
+    again if the file changes, and dropped once the cache is over its
+    budget.
+    '''
+    return _bases.get(path)
+
+def read_manifest( fh ):
+    '''
+    Read the jobs of a manifest. The manifest is either JSON, a list of jobs
+    or an object with a 'jobs' list, or JSONL with one job per line. Each
+    job is an object with an 'op' and the paths it needs:
+
+    - patch: 'unpatched', 'patch' (a path, or a list to stack), 'output',
+      optional 'eof'
+    - diff: 'unpatched', 'patched', 'output', optional 'rle' (default true)
+      and 'format' ('ips', 'bps' or 'ups')
+    - merge: 'patches', 'output', optional 'destination'
+
+    Any job may have an 'id' to tell its result apart.
+
+    :param fh: File handler opened for reading text
+    :returns: List of dicts
+    '''
+    text = fh.read()
+    try:
+        jobs = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(jobs, dict):
+        jobs = jobs['jobs'] if 'jobs' in jobs else [jobs]
+    return jobs
+
+def _run_patch( job ):
+    paths = job['patch'] if isinstance(job['patch'], list) else [job['patch']]
+    fhdest = BytesIO(_base( job['unpatched'] ))
+    fhpatches = [open(path, 'rb') for path in paths]
+    try:
+        formats = [patch_format( fh ) for fh in fhpatches]
+        if len(paths) > 1 and any(fmt not in ('ips', 'ips32') for fmt in formats):
+            raise IpsyError(
+                "Only IPS patches can be stacked")
+        if formats[0] in ('bps', 'ups'):
+            from .bps import bps_patch
+            from .ups import ups_patch
+            apply = bps_patch if formats[0] == 'bps' else ups_patch
+            out = BytesIO()
+            count = apply( fhdest, fhpatches[0], out )
+            fhdest = out
+        elif len(paths) > 1:
+            count = patch( fhdest, fhpatches, job.get('eof', False), mapped=True )
+        else:
+            records = read( fhpatches[0], job.get('eof', False) )
+            _patch_buffered( fhdest, records )
+            count = len(records)
+    finally:
+        _ = [fh.close() for fh in fhpatches]
+    with open(job['output'], 'wb') as fhout:
+        fhout.write(fhdest.getbuffer())
+    return count
+
+def _run_diff( job ):
+    fmt = job.get('format', 'ips')
+    base = _base( job['unpatched'] )
+    if fmt not in ('bps', 'ups') and getsize(job['patched']) != len(base):
+        raise IpsyError(
+            "The two files are of differing size")
+    with open(job['patched'], 'rb') as fhdst, open(job['output'], 'wb') as fhpatch:
+        fhsrc = BytesIO(base)
+        if fmt == 'bps':
+            from .bps import bps_diff
+            return bps_diff( fhsrc, fhdst, fhpatch )
+        if fmt == 'ups':
+            from .ups import ups_diff
+            return ups_diff( fhsrc, fhdst, fhpatch )
+        return len(diff( fhsrc, fhdst, fhpatch, job.get('rle', True) ))
+
+def _run_merge( job ):
+    fhpatches = [open(path, 'rb') for path in job['patches']]
+    try:
+        with open(job['output'], 'wb') as fhout:
+            merge( fhout, *fhpatches, path_dst=job.get('destination') )
+    finally:
+        _ = [fh.close() for fh in fhpatches]
+    return len(fhpatches)
+
+_RUNNERS = {'patch': _run_patch, 'diff': _run_diff, 'merge': _run_merge}
+
+def _run_job( numbered ):
+    '''
+    Run one job of a batch. Never raises, errors are returned.
+    '''
+    number, job = numbered
+    start, op = perf_counter(), job.get('op')
+    try:
+        if op not in _RUNNERS:
+            raise IpsyError(
+                "Unknown batch operation " + repr(op))
+        count = _RUNNERS[op]( job )
+    except Exception as e:
+        return BatchResult(job.get('id', number), op, job.get('output'), 0, perf_counter()-start, str(e))
+    return BatchResult(job.get('id', number), op, job.get('output'), count, perf_counter()-start, None)
+
+def run_batch( jobs, workers=1 ):
+    '''
+    Run many patch, diff and merge jobs in this process, or a pool of them.
+    Unpatched files are kept in a :class:`RomCache`, so each is read once per
+    process while it fits and is unchanged; with a pool, files used by more
+    than one job are read before the workers start so the workers share
+    them. A failing job doesn't stop the others.
+
+    :param jobs: List of dicts, see :func:`read_manifest`
+    :param workers: Number of processes, None for one per core. With 1 the
+                    jobs run in this process.
+    :returns: Generator of :class:`BatchResult`, in the order the jobs
+              finish
+    '''
+    numbered = list(enumerate(jobs))
+    if workers == 1 or len(numbered) < 2:
+        yield from map(_run_job, numbered)
+        return
+    from multiprocessing import get_all_start_methods, get_context
+    if 'fork' in get_all_start_methods():
+        used = {}
+        for job in jobs:
+            if 'unpatched' in job:
+                used[job['unpatched']] = used.get(job['unpatched'], 0) + 1
+        for path, count in used.items():
+            if count > 1:
+                try:
+                    _base( path )
+                except OSError:
+                    pass
+        method = 'fork'
+    else:
+        method = None
+    with get_context(method).Pool(workers) as pool:
+        yield from pool.imap_unordered(_run_job, numbered)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from math import gcd
+from io import SEEK_END, SEEK_SET, UnsupportedOperation
+from zlib import crc32
+from struct import Struct
+from .ipsy import IpsyError, _mapped
+
+__all__ = ['BPS_MAGIC', 'BpsHeader', 'bps_header', 'bps_patch', 'bps_diff']
+
+BPS_MAGIC = b'BPS1'
+BPS_FOOTER_SIZE = 12      # Source, target and patch CRC32
+BPS_CHUNK_SIZE = 2**20    # Bytes read, written and hashed at a time
+BPS_BLOCK_SIZE = 32       # Default size of the pieces bps_diff indexes
+BPS_MIN_MATCH = 8         # Shortest copy bps_diff will emit
+BPS_MIN_READ = 4       # Shortest SourceRead bps_diff will emit
+BPS_SKIP_SHIFT = 6        # bps_diff takes longer steps every 2**6 unmatched bytes
+SOURCE_READ, TARGET_READ, SOURCE_COPY, TARGET_COPY = range(4)
+
+_FOOTER = Struct('<III')
+
+class BpsHeader( namedtuple('BpsHeader', 'source_size target_size metadata') ):
+    '''
+    Header of a BPS file.
+
+    :param source_size: Size of the file the patch applies to
+    :param target_size: Size of the patched file
+    :param metadata: bytes object, usually XML, may be empty
+    '''
+    pass
+
+class _PatchStream:
+    '''
+    Reads the action section of a BPS file a chunk at a time, keeping a
+    running CRC32 of every byte read. The footer is read separately.
+    '''
+
+    def __init__(self, fh):
+        start = fh.tell()
+        fh.seek(0, SEEK_END)
+        size = fh.tell() - start
+        if size < len(BPS_MAGIC) + 3 + BPS_FOOTER_SIZE:
+            raise IpsyError(
+                "BPS file is too small to be valid")
+        fh.seek(start + size - BPS_FOOTER_SIZE, SEEK_SET)
+        self.tail = fh.read(BPS_FOOTER_SIZE)
+        fh.seek(start, SEEK_SET)
+        self.fh, self.buf, self.pos, self.crc = fh, b'', 0, 0
+        self.left = size - BPS_FOOTER_SIZE
+
+    def _fill(self):
+        if self.pos < len(self.buf):
+            return
+        if not self.left:
+            raise IpsyError(
+                "BPS file unexpectedly ended")
+        self.buf = self.fh.read(min(BPS_CHUNK_SIZE, self.left))
+        if not self.buf:
+            raise IpsyError(
+                "BPS file unexpectedly ended")
+        self.crc = crc32(self.buf, self.crc)
+        self.left -= len(self.buf)
+        self.pos = 0
+
+    def done(self):
+        return not self.left and self.pos == len(self.buf)
+
+    def byte(self):
+        self._fill()
+        self.pos += 1
+        return self.buf[self.pos-1]
+
+    def number(self):
+        data, shift = 0, 1
+        while True:
+            x = self.byte()
+            data += (x & 0x7f) * shift
+            if x & 0x80:
+                return data
+            shift <<= 7
+            data += shift
+
+    def signed(self):
+        data = self.number()
+        return -(data >> 1) if data & 1 else data >> 1
+
+    def take(self, n):
+        '''
+        Up to n bytes, never more than what is left in the current chunk.
+        '''
+        self._fill()
+        data = self.buf[self.pos:self.pos+n]
+        self.pos += len(data)
+        return data
+
+    def read(self, n):
+        return b''.join(self.take(n) for n in _pieces(n, self))
+
+    def footer(self):
+        '''
+        Source, target and patch CRC32 from the end of the file.
+        '''
+        return _FOOTER.unpack(self.tail)
+
+    def finish(self):
+        '''
+        Skip past the footer, adding what the patch checksum covers.
+        '''
+        self.crc = crc32(self.fh.read(BPS_FOOTER_SIZE)[:-4], self.crc)
+
+def _pieces( n, stream ):
+    '''
+    Lengths to pass to :meth:`_PatchStream.take` to get n bytes in total.
+    '''
+    while n:
+        stream._fill()
+        piece = min(n, len(stream.buf) - stream.pos)
+        yield piece
+        n -= piece
+
+class _Target:
+    '''
+    Sequential writer for the patched file. Output is buffered a chunk at a
+    time and hashed as it is flushed. Bytes that are already flushed are read
+    back from the file when a TargetCopy needs them, so only one chunk of the
+    target is ever held in memory.
+    '''
+
+    def __init__(self, fh):
+        self.fh, self.base, self.flushed, self.crc = fh, fh.tell(), 0, 0
+        self.pending = bytearray()
+
+    def __len__(self):
+        return self.flushed + len(self.pending)
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= BPS_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.fh.write(self.pending)
+        self.crc = crc32(self.pending, self.crc)
+        self.flushed += len(self.pending)
+        self.pending = bytearray()
+
+    def read(self, offset, n):
+        '''
+        Up to n already written bytes starting at offset.
+        '''
+        if offset >= self.flushed:
+            return bytes(self.pending[offset-self.flushed:offset-self.flushed+n])
+        n = min(n, self.flushed - offset)
+        try:
+            self.fh.seek(self.base + offset)
+            data = self.fh.read(n)
+            self.fh.seek(self.base + self.flushed)
+        except (OSError, UnsupportedOperation):
+            data = b''
+        if len(data) != n:
+            raise IpsyError(
+                "BPS TargetCopy needs the patched file to be readable")
+        return data
+
+def _read_header( stream ):
+    if stream.read(len(BPS_MAGIC)) != BPS_MAGIC:
+        raise IpsyError(
+            "BPS file missing header")
+    source_size, target_size = stream.number(), stream.number()
+    return BpsHeader(source_size, target_size, stream.read(stream.number()))
+
+def bps_header( fhpatch ):
+    '''
+    Read the header of a BPS file.
+
+    :param fhpatch: File handler for BPS patch
+    :returns: :class:`BpsHeader`
+    '''
+    return _read_header( _PatchStream( fhpatch ) )
+
+def _chunked_crc( source ):
+    crc = 0
+    for i in range(0, len(source), BPS_CHUNK_SIZE):
+        crc = crc32(source[i:i+BPS_CHUNK_SIZE], crc)
+    return crc
+
+def bps_patch( fhsrc, fhpatch, fhdest, verify=True ):
+    '''
+    Apply a BPS patch, writing the patched file from start to end. The patch
+    is streamed, the source is memory mapped and the target is only buffered
+    a chunk at a time, so memory use doesn't grow with the size of the files.
+    The destination should be opened 'w+b' so TargetCopy actions can read
+    back what has already been written.
+
+    :param fhsrc: File handler of the unpatched file
+    :param fhpatch: File handler of the BPS patch
+    :param fhdest: File handler for the patched file
+    :param verify: Check the source, target and patch CRC32 and sizes
+    :returns: Number of actions applied by the patch
+    '''
+    stream = _PatchStream( fhpatch )
+    header = _read_header( stream )
+    target = _Target( fhdest )
+    count = source_offset = target_offset = 0
+    with _mapped( fhsrc ) as source:
+        if verify and len(source) != header.source_size:
+            raise IpsyError(
+                "Source file is not the size the BPS patch expects")
+        if verify and _chunked_crc( source ) != stream.footer()[0]:
+            raise IpsyError(
+                "Source checksum does not match the BPS patch")
+        while not stream.done():
+            data = stream.number()
+            action, length = data & 3, (data >> 2) + 1
+            if len(target) + length > header.target_size:
+                raise IpsyError(
+                    "BPS patch writes past the end of the target")
+            if action == SOURCE_READ:
+                start = len(target)
+                if start + length > len(source):
+                    raise IpsyError(
+                        "BPS SourceRead past the end of the source")
+                for i in range(start, start + length, BPS_CHUNK_SIZE):
+                    target.write(source[i:min(i+BPS_CHUNK_SIZE, start+length)])
+            elif action == TARGET_READ:
+                for n in _pieces( length, stream ):
+                    target.write(stream.take(n))
+            elif action == SOURCE_COPY:
+                source_offset += stream.signed()
+                if source_offset < 0 or source_offset + length > len(source):
+                    raise IpsyError(
+                        "BPS SourceCopy outside of the source")
+                for i in range(source_offset, source_offset + length, BPS_CHUNK_SIZE):
+                    target.write(source[i:min(i+BPS_CHUNK_SIZE, source_offset+length)])
+                source_offset += length
+            else:
+                target_offset += stream.signed()
+                if target_offset < 0 or target_offset >= len(target):
+                    raise IpsyError(
+                        "BPS TargetCopy outside of the written target")
+                while length:
+                    avail = len(target) - target_offset
+                    piece = target.read(target_offset, min(length, avail, BPS_CHUNK_SIZE))
+                    if avail < length and len(piece) == avail:
+                        # Reading past what is written repeats the last avail bytes
+                        piece = (piece * -(-min(length, BPS_CHUNK_SIZE) // avail))[:min(length, BPS_CHUNK_SIZE)]
+                    target.write(piece)
+                    target_offset += len(piece)
+                    length -= len(piece)
+            count += 1
+    target.flush()
+    stream.finish()
+    _, target_crc, patch_crc = stream.footer()
+    if verify:
+        if len(target) != header.target_size:
+            raise IpsyError(
+                "BPS patch did not write the whole target")
+        if patch_crc != stream.crc:
+            raise IpsyError(
+                "BPS patch checksum does not match, the patch is corrupt")
+        if target_crc != target.crc:
+            raise IpsyError(
+                "Target checksum does not match the BPS patch")
+    return count
+
+def _number( data ):
+    '''
+    Encode a BPS variable-length number.
+    '''
+    out = bytearray()
+    while True:
+        x = data & 0x7f
+        data >>= 7
+        if data == 0:
+            out.append(0x80 | x)
+            return bytes(out)
+        out.append(x)
+        data -= 1
+
+def _signed( data ):
+    return _number( (abs(data) << 1) | (data < 0) )
+
+def _forward( a, i, b, j, limit ):
+    '''
+    Number of equal bytes at a[i:] and b[j:], at most limit. Compares growing
+    slices, then narrows in on the first difference, so long matches cost a
+    handful of comparisons.
+    '''
+    n, step = 0, BPS_MIN_MATCH
+    while step <= limit - n and a[i+n:i+n+step] == b[j+n:j+n+step]:
+        n, step = n + step, min(step * 2, BPS_CHUNK_SIZE)
+    while step > 1:
+        step //= 2
+        if step <= limit - n and a[i+n:i+n+step] == b[j+n:j+n+step]:
+            n += step
+    if n < limit and a[i+n] == b[j+n]:
+        n += 1
+    return n
+
+def _backward( a, i, b, j, limit ):
+    '''
+    Number of equal bytes just before a[i] and b[j], at most limit.
+    '''
+    n, step = 0, 1
+    while step <= limit - n and a[i-n-step:i-n] == b[j-n-step:j-n]:
+        n, step = n + step, step * 2
+    while step > 1:
+        step //= 2
+        if step <= limit - n and a[i-n-step:i-n] == b[j-n-step:j-n]:
+            n += step
+    return n
+
+def bps_diff( fhsrc, fhdst, fhpatch, block=BPS_BLOCK_SIZE, metadata=b'' ):
+    '''
+    Create a BPS patch. Unlike :func:`ipsy.diff` the files may differ in size
+    and moved data is found wherever it ends up.
+
+    Every block-aligned piece of the source, and of the target as it is
+    written, is indexed by its bytes. The target is then walked greedily:
+    at each position the longest of a SourceRead, a SourceCopy continuing the
+    previous one, an indexed SourceCopy or TargetCopy, or a TargetCopy of the
+    previous byte (runs) is taken, matches are extended in both directions
+    by comparing slices, and anything unmatched becomes a TargetRead. A
+    smaller block finds more matches, so smaller patches, at the cost of
+    time and memory.
+
+    Through unmatched data the walk speeds up, taking a longer step every
+    2**:data:`BPS_SKIP_SHIFT` bytes since the last match, up to half the
+    block size. Steps are kept coprime with the block size, so a match
+    longer than (step + 1) blocks is never stepped over, and a match found
+    late is extended back over the bytes stepped past.
+
+    :param fhsrc: File handler of the unpatched file
+    :param fhdst: File handler of the patched file
+    :param fhpatch: File handler for the BPS file
+    :param block: Size of the indexed pieces, at least :data:`BPS_MIN_MATCH`
+    :param metadata: bytes object stored in the patch header
+    :returns: Number of actions in the patch
+    '''
+    source, target = fhsrc.read(), fhdst.read()
+    block = max(block, BPS_MIN_MATCH)
+    sindex = {}
+    for i in range(len(source) - block, -1, -block):
+        sindex[source[i:i+block]] = i
+    tindex, tnext = {}, 0
+    steps = [n for n in range(1, block // 2 + 1) if gcd(n, block) == 1]
+    body = [BPS_MAGIC, _number( len(source) ), _number( len(target) ),
+            _number( len(metadata) ), metadata]
+    actions = source_offset = target_offset = p = literal = 0
+
+    def emit( command, length, *extra ):
+        nonlocal actions
+        body.append(_number( command | ((length - 1) << 2) ))
+        body.extend(extra)
+        actions += 1
+
+    while p < len(target):
+        while tnext + block <= p:
+            tindex.setdefault(target[tnext:tnext+block], tnext)
+            tnext += block
+        left = len(target) - p
+        best, kind, start = 0, None, None
+        if p < len(source) and source[p] == target[p]:
+            best = _forward( source, p, target, p, min(left, len(source) - p) )
+            kind, start = SOURCE_READ, p
+        if source_offset < len(source) and source_offset != p and source[source_offset] == target[p]:
+            n = _forward( source, source_offset, target, p, min(left, len(source) - source_offset) )
+            if n > best:
+                best, kind, start = n, SOURCE_COPY, source_offset
+        key = target[p:p+block]
+        for index, data, kind_hit in ((sindex, source, SOURCE_COPY), (tindex, target, TARGET_COPY)):
+            hit = index.get(key)
+            if hit is not None and hit != start:
+                n = _forward( data, hit, target, p, min(left, len(data) - hit) )
+                if n > best:
+                    best, kind, start = n, kind_hit, hit
+        if p and target[p-1] == target[p]:
+            n = _forward( target, p-1, target, p, left )
+            if n > best:
+                best, kind, start = n, TARGET_COPY, p-1
+        if best < (BPS_MIN_MATCH if kind != SOURCE_READ else BPS_MIN_READ):
+            p += steps[min((p - literal) >> BPS_SKIP_SHIFT, len(steps) - 1)]
+            continue
+        back = 0
+        if kind == SOURCE_READ:
+            back = _backward( source, p, target, p, p - literal )
+        else:
+            back = _backward( source if kind == SOURCE_COPY else target, start, target, p,
+                              min(p - literal, start) )
+        p, start, best = p - back, start - back, best + back
+        if p > literal:
+            emit( TARGET_READ, p - literal, target[literal:p] )
+        if kind == SOURCE_READ:
+            emit( SOURCE_READ, best )
+        elif kind == SOURCE_COPY:
+            emit( SOURCE_COPY, best, _signed( start - source_offset ) )
+            source_offset = start + best
+        else:
+            emit( TARGET_COPY, best, _signed( start - target_offset ) )
+            target_offset = start + best
+        p = literal = p + best
+    p = len(target) # A step may have gone past the end
+    if p > literal:
+        emit( TARGET_READ, p - literal, target[literal:p] )
+    crc = 0
+    for piece in body:
+        crc = crc32(piece, crc)
+        fhpatch.write(piece)
+    footer = _FOOTER.pack(_chunked_crc( source ), _chunked_crc( target ), 0)[:-4]
+    crc = crc32(footer, crc)
+    fhpatch.write(footer + crc.to_bytes(4, byteorder='little'))
+    return actions
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from hashlib import sha256
+from os import makedirs, listdir, replace, remove, stat, utime, path as ospath
+from shutil import copyfileobj
+from struct import Struct
+from tempfile import mkstemp
+from threading import Lock
+
+__all__ = ['CACHE_MAX_SIZE', 'ROM_CACHE_SIZE', 'ResultCache', 'RomCache']
+
+CACHE_MAX_SIZE = 2**30    # 1 GiB of results kept by default
+CACHE_SUFFIX = '.result'  # Added to the key to name an entry
+CACHE_CHUNK_SIZE = 2**20  # Bytes hashed and copied at a time
+ROM_CACHE_SIZE = 2**28    # 256 MiB of base ROMs kept in memory by default
+
+_COUNT = Struct('<Q') # Record count stored ahead of each result
+
+class ResultCache:
+    '''
+    On-disk cache of the results of :func:`diff`, :func:`merge` and
+    :func:`patch_many`. Entries are keyed by the SHA-256 of every input and
+    the options that change the result, so a hit only costs hashing the
+    inputs and copying the result out. Entries are written to a temporary
+    file and renamed into place, so a reader never sees half an entry, and
+    the least recently used entries are removed once the cache is over its
+    size limit.
+
+    :param path: Directory holding the cache, created if missing
+    :param max_size: Bytes of entries to keep
+    '''
+
+    def __init__(self, path, max_size=CACHE_MAX_SIZE):
+        self.path, self.max_size = path, max_size
+        self.hits = self.misses = self.stores = self.evictions = 0
+        makedirs(path, exist_ok=True)
+
+    def digest(self, fh):
+        '''
+        Hash the rest of a file. The position of the file handler is left
+        where it was.
+
+        :param fh: File handler opened for reading, or a path
+        :returns: Hex digest
+        '''
+        if isinstance(fh, str):
+            with open(fh, 'rb') as fh:
+                return self.digest(fh)
+        h, start = sha256(), fh.tell()
+        for chunk in iter(lambda: fh.read(CACHE_CHUNK_SIZE), b''):
+            h.update(chunk)
+        fh.seek(start)
+        return h.hexdigest()
+
+    def key(self, operation, digests, **options):
+        '''
+        Name the result of an operation.
+
+        :param operation: Name of the operation, e.g. 'diff'
+        :param digests: Digests of the inputs, in order, see :meth:`digest`
+        :param options: Options that change the result
+        :returns: Hex digest
+        '''
+        h = sha256(operation.encode())
+        for digest in digests:
+            h.update(b'\x00' + digest.encode())
+        for name in sorted(options):
+            h.update(('\x00' + name + '=' + repr(options[name])).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return ospath.join(self.path, key + CACHE_SUFFIX)
+
+    def _open(self, key):
+        try:
+            fh = open(self._entry(key), 'rb')
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            utime(self._entry(key))
+        except OSError:
+            pass
+        return fh
+
+    def get(self, key):
+        '''
+        Look up a result.
+
+        :param key: See :meth:`key`
+        :returns: (bytes of the result, record count), or None on a miss
+        '''
+        fh = self._open(key)
+        if fh is None:
+            return None
+        with fh:
+            count, = _COUNT.unpack(fh.read(_COUNT.size))
+            return fh.read(), count
+
+    def get_file(self, key, path_out):
+        '''
+        Look up a result and copy it to a file.
+
+        :param key: See :meth:`key`
+        :param path_out: Path of the file to create
+        :returns: Record count, or None on a miss
+        '''
+        fh = self._open(key)
+        if fh is None:
+            return None
+        with fh, open(path_out, 'wb') as fhout:
+            count, = _COUNT.unpack(fh.read(_COUNT.size))
+            copyfileobj(fh, fhout, CACHE_CHUNK_SIZE)
+        return count
+
+    def put(self, key, data, count=0):
+        '''
+        Store a result, then trim the cache to its size limit.
+
+        :param key: See :meth:`key`
+        :param data: Bytes-like object of the result, or a path to copy it from
+        :param count: Number of records (or actions, hunks) in the result
+        '''
+        fd, temp = mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with open(fd, 'wb') as fh:
+                fh.write(_COUNT.pack(count))
+                if isinstance(data, str):
+                    with open(data, 'rb') as fhin:
+                        copyfileobj(fhin, fh, CACHE_CHUNK_SIZE)
+                else:
+                    fh.write(data)
+            replace(temp, self._entry(key))
+        except BaseException:
+            remove(temp)
+            raise
+        self.stores += 1
+        self.trim()
+
+    def trim(self):
+        '''
+        Remove the least recently used entries until the cache fits in
+        max_size.
+        '''
+        entries, total = [], 0
+        for name in listdir(self.path):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                info = stat(ospath.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((info.st_mtime_ns, info.st_size, name))
+            total += info.st_size
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                remove(ospath.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        '''
+        :returns: dict of hits, misses, stores and evictions since the cache
+                  was opened
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'evictions': self.evictions}
+
+class RomCache:
+    '''
+    Base ROMs kept in memory, least recently used first out once their total
+    size is over a byte budget. A ROM is read again when its size or
+    modification time changes. Safe to use from several threads.
+
+    :param max_size: Bytes of ROMs to keep
+    '''
+
+    def __init__(self, max_size=ROM_CACHE_SIZE):
+        self.max_size, self.size = max_size, 0
+        self.roms = OrderedDict() # Path to (size, mtime, bytes)
+        self.hits = self.misses = self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, path):
+        '''
+        :param path: Path of the ROM
+        :returns: bytes of the ROM
+        '''
+        info = stat(path)
+        with self.lock:
+            entry = self.roms.get(path)
+            if entry and entry[:2] == (info.st_size, info.st_mtime_ns):
+                self.hits += 1
+                self.roms.move_to_end(path)
+                return entry[2]
+            self.misses += 1
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        with self.lock:
+            if path in self.roms:
+                self.size -= len(self.roms.pop(path)[2])
+            if len(data) <= self.max_size:
+                self.roms[path] = (info.st_size, info.st_mtime_ns, data)
+                self.size += len(data)
+            while self.size > self.max_size:
+                self.size -= len(self.roms.popitem(last=False)[1][2])
+                self.evictions += 1
+        return data
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+from hashlib import md5, sha1
+from zlib import crc32
+from .ipsy import IpsyError, IpsOverlay, iter_records, patch_format
+from . import stats as _stats
+
+__all__ = ['VERIFY_ALGORITHMS', 'VERIFY_CHUNK_SIZE', 'verify']
+
+VERIFY_CHUNK_SIZE = 2**20 # Bytes of the unpatched file read at a time
+
+class _Crc32:
+    '''
+    CRC32 behind the same update and hexdigest calls as hashlib.
+    '''
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+VERIFY_ALGORITHMS = {'crc32': _Crc32, 'md5': md5, 'sha1': sha1} # Hashes verify can feed, by name
+
+class _Patched:
+    '''
+    Hash of one patched file, fed a chunk of the unpatched file at a time.
+    The spans of the patch replace the bytes of the chunk they cover.
+    '''
+
+    def __init__(self, spans, algorithm):
+        self.spans, self.k = spans, 0
+        self.hasher = VERIFY_ALGORITHMS[algorithm]()
+
+    def feed(self, chunk, start):
+        '''
+        :param chunk: memoryview of the unpatched file
+        :param start: Offset of the first byte of chunk in the file
+        '''
+        pos, stop, spans, update = start, start + len(chunk), self.spans, self.hasher.update
+        while self.k < len(spans) and spans[self.k][0] < stop:
+            offset, data = spans[self.k]
+            if offset > pos:
+                update(chunk[pos-start:offset-start])
+                pos = offset
+            end = min(offset + len(data), stop)
+            update(data[pos-offset:end-offset])
+            pos = end
+            if end < offset + len(data):
+                return
+            self.k += 1
+        if pos < stop:
+            update(chunk[pos-start:])
+
+    def finish(self, size):
+        '''
+        Hash whatever the patch writes past the end of the unpatched file,
+        with zeros in the gaps, as patching would leave them.
+
+        :param size: Size of the unpatched file
+        :returns: Hex digest
+        '''
+        pos, zeros = size, memoryview(bytes(VERIFY_CHUNK_SIZE))
+        for offset, data in self.spans[self.k:]:
+            while pos < offset:
+                self.hasher.update(zeros[:min(offset-pos, len(zeros))])
+                pos += min(offset-pos, len(zeros))
+            self.hasher.update(data[pos-offset:])
+            pos = offset + len(data)
+        return self.hasher.hexdigest()
+
+def verify( fhsrc, fhpatches, algorithm='crc32', EOFcontinue=False ):
+    '''
+    Hash the files that applying patches to an unpatched file would give,
+    without writing them. Each IPS (or IPS32) patch is laid into an
+    :class:`IpsOverlay`, so later records win, and the unpatched file is read
+    once, :data:`VERIFY_CHUNK_SIZE` bytes at a time, with every chunk fed to
+    the hash of every patch with the patch's bytes in place. BPS and UPS
+    patches don't keep the layout of the unpatched file, so they are applied
+    in memory and hashed whole.
+
+    :param fhsrc: File handler of the unpatched file, read from its current
+                  position. Needn't be seekable unless a patch is BPS or UPS.
+    :param fhpatches: File handler of a patch, or a list of them
+    :param algorithm: Name of a hash in :data:`VERIFY_ALGORITHMS`
+    :param EOFcontinue: Continue processing until the real EOF
+                        is found (last 3 bytes of file)
+    :returns: Hex digest of the patched file, or a list of them in the order
+              of fhpatches
+    '''
+    if algorithm not in VERIFY_ALGORITHMS:
+        raise IpsyError(
+            "Unknown hash " + repr(algorithm) + ", expected one of " + ', '.join(VERIFY_ALGORITHMS))
+    single = not isinstance(fhpatches, (list, tuple))
+    fhpatches = [fhpatches] if single else fhpatches
+    with _stats.stage('verify'):
+        formats = [patch_format( fh ) for fh in fhpatches]
+        start = fhsrc.tell() if any(fmt in ('bps', 'ups') for fmt in formats) else None
+        hashes = {i: _Patched(list(IpsOverlay(iter_records( fh, EOFcontinue )).spans()), algorithm)
+                  for i, (fh, fmt) in enumerate(zip(fhpatches, formats)) if fmt not in ('bps', 'ups')}
+        buf, size = bytearray(VERIFY_CHUNK_SIZE), 0
+        view = memoryview(buf)
+        while True:
+            n = fhsrc.readinto(buf)
+            if not n:
+                break
+            for h in hashes.values():
+                h.feed(view[:n], size)
+            size += n
+        _stats.add('verify.bytes', size)
+        digests = {i: h.finish(size) for i, h in hashes.items()}
+        for i, fmt in enumerate(formats):
+            if fmt in ('bps', 'ups'):
+                digests[i] = _verify_applied( fhsrc, start, fhpatches[i], fmt, algorithm )
+    digests = [digests[i] for i in range(len(fhpatches))]
+    return digests[0] if single else digests
+
+def _verify_applied( fhsrc, start, fhpatch, fmt, algorithm ):
+    '''
+    Hash of a BPS or UPS patch applied in memory.
+    '''
+    from io import BytesIO
+    from .bps import bps_patch
+    from .ups import ups_patch
+    fhsrc.seek(start)
+    out = BytesIO()
+    (bps_patch if fmt == 'bps' else ups_patch)( fhsrc, fhpatch, out )
+    hasher = VERIFY_ALGORITHMS[algorithm]()
+    hasher.update(out.getbuffer())
+    return hasher.hexdigest()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from heapq import heappush, heappop
+from .ipsy import IpsOverlay, iter_records
+
+__all__ = ['Overlap', 'find_overlaps']
+
+class Overlap( namedtuple('Overlap', 'first second start end identical') ):
+    '''
+    A range of bytes written by two patches.
+
+    :param first: Index of the first patch
+    :param second: Index of the second patch, always greater than first
+    :param start: First byte both patches write
+    :param end: Byte after the last, exclusive
+    :param identical: True if both patches write the same bytes here, so
+                      applying them in either order gives the same file.
+                      None unless asked for.
+    '''
+    pass
+
+def find_overlaps( fhpatches, EOFcontinue=False, compare=False ):
+    '''
+    Find every range written by more than one patch, with one sweep over the
+    records of all of them. Each patch is first reduced to the bytes it
+    actually writes, so records overlapping inside a single patch don't
+    count. Runs in O(N log N + K) for N spans and K overlaps.
+
+    :param fhpatches: List of File Handlers for IPS files, or of paths to
+                      them. A path is opened only while its patch is reduced
+                      to spans, so any number of patches can be checked.
+    :param EOFcontinue: Continue processing until the real EOF
+                        is found (last 3 bytes of file)
+    :param compare: Also tell overlaps that write identical bytes apart from
+                    real conflicts, see :class:`Overlap`
+    :returns: List of :class:`Overlap` ordered by start
+    '''
+    spans = []
+    for p, patch in enumerate(fhpatches):
+        fh = open(patch, 'rb') if isinstance(patch, str) else patch
+        try:
+            for offset, data in IpsOverlay(iter_records( fh, EOFcontinue )).spans():
+                spans.append((offset, offset + len(data), p, data if compare else None))
+        finally:
+            if fh is not patch:
+                fh.close()
+    spans.sort(key=lambda span: span[0])
+    overlaps, active = [], []
+    for i, (start, end, p, data) in enumerate(spans):
+        while active and active[0][0] <= start:
+            heappop(active)
+        for _, _, (other_start, other_end, q, other_data) in active:
+            stop = min(end, other_end)
+            identical = None
+            if compare:
+                identical = data[:stop-start] == other_data[start-other_start:stop-other_start]
+            overlaps.append(Overlap(min(p, q), max(p, q), start, stop, identical))
+        heappush(active, (end, i, (start, end, p, data)))
+    return overlaps
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+from array import array
+from bisect import bisect_left
+from os import fstat, replace, getpid
+from struct import Struct
+from .ipsy import IpsRecord, IpsOverlay, RecordTable, read, _view
+
+__all__ = ['INDEX_SUFFIX', 'PatchIndex']
+
+INDEX_SUFFIX = '.ipsyidx' # Added to a patch's path to name its index
+INDEX_MAGIC = b'IPSYIDX1'
+
+_INDEX_HEADER = Struct('<QQQ?') # Size and mtime of the patch, where it was read from, EOFcontinue
+_COUNT = Struct('<Q')
+
+class PatchIndex:
+    '''
+    Offset index over an IPS file, for asking which records touch an address
+    or a range without decoding every record. The patch is memory mapped and
+    its record headers are scanned the first time the index is queried; the
+    payloads are never copied. Records are kept sorted by offset, under a
+    segment tree of the furthest byte each part of them reaches, so a query
+    costs O(log n) for every record that matches, however long the others.
+
+    :param fhpatch: File handler for IPS patch, kept open while the index is used
+    :param EOFcontinue: Continue processing until the real EOF
+                        is found (last 3 bytes of file)
+    :param sidecar: Path to keep the index in between runs, e.g. the path of
+                    the patch plus :data:`INDEX_SUFFIX`. It is rebuilt when the
+                    size or modification time of the patch changes.
+    '''
+
+    def __init__(self, fhpatch, EOFcontinue=False, sidecar=None):
+        self.fhpatch, self.EOFcontinue, self.sidecar = fhpatch, EOFcontinue, sidecar
+        self.table = None
+
+    def _key(self):
+        try:
+            info, start = fstat(self.fhpatch.fileno()), self.fhpatch.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+        return INDEX_MAGIC + _INDEX_HEADER.pack(info.st_size, info.st_mtime_ns, start, self.EOFcontinue)
+
+    def _load(self, key):
+        try:
+            with open(self.sidecar, 'rb') as fh:
+                saved = fh.read()
+        except OSError:
+            return None
+        if saved[:len(key)] != key or len(saved) < len(key) + _COUNT.size:
+            return None
+        count, = _COUNT.unpack_from(saved, len(key))
+        columns, pos = [array(code) for code in 'IIIQ'], len(key) + _COUNT.size
+        if len(saved) != pos + count*sum(column.itemsize for column in columns):
+            return None # Cut short or padded, read the patch again
+        for column in columns:
+            column.frombytes(saved[pos:pos + count*column.itemsize])
+            pos += count*column.itemsize
+        return RecordTable._columns(*columns, _view( self.fhpatch ))
+
+    def _save(self, key, table):
+        temp = self.sidecar + '.' + str(getpid())
+        try:
+            with open(temp, 'wb') as fh:
+                fh.write(key + _COUNT.pack(len(table)))
+                for column in (table.offsets, table.sizes, table.rle_sizes, table.positions):
+                    column.tofile(fh)
+            replace(temp, self.sidecar)
+        except OSError:
+            pass
+
+    def _build(self):
+        if self.table is not None:
+            return
+        key = self._key() if self.sidecar else None
+        table = self._load(key) if key else None
+        if table is None:
+            table = read( self.fhpatch, self.EOFcontinue, table=True )
+            if key:
+                self._save(key, table)
+        self.table = table
+        order = sorted(range(len(table)), key=table.offsets.__getitem__)
+        ends = table.last_bytes()
+        self.order = array('I', order)
+        self.starts = array('I', map(table.offsets.__getitem__, order))
+        # Segment tree of the furthest byte written, leaves in offset order
+        self.leaves = 1 << max(len(order)-1, 0).bit_length()
+        self.reach = array('Q', bytes(16*self.leaves))
+        self.reach[self.leaves:self.leaves + len(order)] = array('Q', map(ends.__getitem__, order))
+        for i in range(self.leaves-1, 0, -1):
+            self.reach[i] = max(self.reach[2*i], self.reach[2*i+1])
+
+    def __len__(self):
+        self._build()
+        return len(self.table)
+
+    def rows(self, start, stop=None):
+        '''
+        Find the records that write any byte in [start, stop).
+
+        :param start: First address
+        :param stop: Address after the last, defaults to start + 1
+        :returns: List of record numbers, in the order they appear in the patch
+        '''
+        self._build()
+        stop = start + 1 if stop is None else stop
+        if stop <= start:
+            return []
+        hi, reach, found = bisect_left(self.starts, stop), self.reach, []
+        todo = [(1, 0, self.leaves)] # Node, first leaf under it, leaves under it
+        while todo:
+            i, first, width = todo.pop()
+            if first >= hi or reach[i] <= start:
+                continue
+            if width == 1:
+                found.append(self.order[first])
+            else:
+                width //= 2
+                todo += ((2*i+1, first + width, width), (2*i, first, width))
+        return sorted(found)
+
+    def records_at(self, address):
+        '''
+        :param address: Address in the patched file
+        :returns: List of :class:`IpsRecord` that write to address, in patch order
+        '''
+        return [self.table[i] for i in self.rows(address)]
+
+    def records_in(self, start, stop):
+        '''
+        :param start: First address
+        :param stop: Address after the last
+        :returns: List of :class:`IpsRecord` that write to [start, stop), in patch order
+        '''
+        return [self.table[i] for i in self.rows(start, stop)]
+
+    def writes(self, start, stop):
+        '''
+        What applying the patch writes to [start, stop). Where records
+        overlap the later one wins, as it would when patching.
+
+        :param start: First address
+        :param stop: Address after the last
+        :returns: List of (offset, bytes) tuples in offset order, one per
+                  contiguous span written
+        '''
+        clipped = []
+        for r in self.records_in(start, stop):
+            lo, hi = max(r.offset, start), min(r.last_byte(), stop)
+            if r.size:
+                data = bytes(r.data[lo-r.offset:hi-r.offset])
+            else:
+                data = bytes(r.data[:1])*(hi-lo)
+            clipped.append(IpsRecord(lo, hi-lo, 0, data))
+        return list(IpsOverlay(clipped).spans())
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
 from collections import namedtuple
-from itertools import groupby
-from functools import partial
+from contextlib import contextmanager
+from itertools import chain, islice
+from array import array
+from heapq import heappush, heappop
+from operator import add, itemgetter
+from bisect import bisect_left, bisect_right
 from warnings import warn
-from os import SEEK_CUR
-from io import BytesIO
-
-# For 0.3 release
-# TODO Improve diff or RLE algorithm - src = 1 2 1 2 1 2 -> dest = 1 1 1 1 1 1
+from io import BytesIO, UnsupportedOperation, SEEK_END
+from mmap import mmap, ACCESS_READ, ACCESS_COPY
+from shutil import copyfile
+from os import cpu_count, stat, replace, remove, getpid
+from time import perf_counter
+from struct import Struct, error as StructError
+import re
+from . import stats as _stats
 
 RECORD_HEADER_SIZE = 5
 RECORD_OFFSET_SIZE = 3
@@ -19,12 +26,45 @@ MIN_RECORD = 6            # Minimum viable size of a record
 MIN_COMPRESS = 4          # Compressing a size 4 record only saves 1 byte
 MAX_UNPATCHED = 2**24     # 16 MiB, largest value we can offset to
 MAX_RECORD_SIZE = 2**16-1 # Max value held in 2 bytes
+EOF_OFFSET = int.from_bytes(b'EOF', byteorder='big') # Offset that reads as the footer
+IPS32_HEADER = b'IPS32'
+IPS32_FOOTER = b'EEOF'
+IPS32_OFFSET_SIZE = 4
+MAX_UNPATCHED_IPS32 = 2**32 # 4 GiB, largest value IPS32 can offset to
+EEOF_OFFSET = int.from_bytes(IPS32_FOOTER, byteorder='big') # Offset that reads as the IPS32 footer
+DIFF_BLOCK_SIZE = 2**16   # Bytes compared at a time by diff
+DIFF_SUB_BLOCK_SIZE = 2**8 # Piece of a differing block that is XORed
+DIFF_STREAM_WINDOW = 2**20 # Bytes of each stream read at a time by diff_stream
+LITERAL_COST = RECORD_OFFSET_SIZE + RECORD_SIZE_SIZE # Bytes before a record's data
+RLE_COST = LITERAL_COST + RECORD_SIZE_SIZE + RECORD_RLE_DATA_SIZE # Whole RLE record
+MAX_BRIDGE = RLE_COST     # Unchanged bytes the encoder will consider spanning
+LITERAL_COST_32 = IPS32_OFFSET_SIZE + RECORD_SIZE_SIZE # As above, in IPS32
+RLE_COST_32 = LITERAL_COST_32 + RECORD_SIZE_SIZE + RECORD_RLE_DATA_SIZE
+WRITE_BATCH = 2**12       # Records serialized at a time when writing a generator
+DIFF_TASKS_PER_WORKER = 4 # Chunks a parallel diff hands each process, to even out the load
+HASH_BLOCK_SIZE = 2**12   # Bytes covered by each block hash
+HASH_DIGEST_SIZE = 32     # Bytes of SHA-256 digest kept per block
+HASH_SUFFIX = '.ipsyhash' # Added to a file's path to name its block hash cache
+HASH_MAGIC = b'IPSYHASH'
+
+PATCH_FORMATS = {b'PATCH': 'ips', IPS32_HEADER: 'ips32', b'BPS1': 'bps', b'UPS1': 'ups'} # Magic at the start of each format
+
+_NONZERO = re.compile(rb'[^\x00]+')
+_RECORD_START = Struct('>HBH') # Offset as 2 + 1 bytes, then size
+_RLE_SIZE = Struct('>H')
+_RLE_RECORD = Struct('>HBHHB') # Offset, 0 size, RLE size and value
+_RECORD_START_32 = Struct('>IH')
+_RLE_RECORD_32 = Struct('>IHHB')
+_FOOTER_OFFSETS = (EOF_OFFSET, EEOF_OFFSET) # Offsets no record may start at, in either format
+_FRAMING = {False: (b"PATCH", b"EOF"), True: (IPS32_HEADER, IPS32_FOOTER)} # Header and footer, by wide
+_HASH_HEADER = Struct('<QQI') # Size and mtime of the hashed file, block size
+_RUN = re.compile(rb'(.)\1{%d,}' % (MIN_COMPRESS-1), re.DOTALL)
 
 class IpsRecord( namedtuple('IpsRecord', 'offset size rle_size data') ):
     '''
     Data container for one record of an IPS file.
 
-    :param offset: offset in first 3 bytes of the record, stored as int
+    :param offset: offset in first 3 bytes of the record (4 in IPS32), stored as int
     :param size: size in the next 2 bytes, stored as int
     :param rle_size: size in the next 2 bytes if previous was 0, stored as int
     :param data: bytes object of data with length 'size' or 'rle_size'
@@ -46,267 +86,1512 @@ class IpsRecord( namedtuple('IpsRecord', 'offset size rle_size data') ):
         '''
         if not self.rle_size:
             return self
-        return IpsRecord(self.offset, self.rle_size, 0, self.data*self.rle_size)
+        return IpsRecord(self.offset, self.rle_size, 0, bytes(self.data)*self.rle_size)
 
     def compress(self):
         '''
         Attempts to RLE compress the record into a single, smaller, record. May
-        split the record to multiple.
+        split the record to multiple. See :func:`encode`.
 
         :returns: List of: self (no compression) or compressed :class:`IpsRecord`
         '''
-        if not self.size or len(self.data) < MIN_COMPRESS or\
-           not any(i>=MIN_COMPRESS for i in [len(list(g)) for _,g in groupby(self.data)]):
+        if not self.size or len(self.data) < MIN_COMPRESS or not _RUN.search(self.data):
             return [self]
-        if len([len(list(g)) for _,g in groupby(self.data)]) == 1:
-            return [IpsRecord(self.offset, 0, len(self.data), self.data[0])]
-        offset, run, rle = 0, b'', []
-        for d,g in groupby(self.data):
-            size = len(list(g))
-            if size >= MIN_COMPRESS:
-                totaloff = self.offset+offset
-                if run:
-                    rle.append(IpsRecord(totaloff-len(run), len(run), 0, run))
-                    run = b''
-                rle.append(IpsRecord( totaloff, 0, size, bytes([d])))
-            else:
-                run += (bytes([d])*size)
-            offset += size
-        if run:
-            rle.append(IpsRecord(self.offset+offset-len(run), len(run), 0, run))
-        return rle
-
-    def flatten(self):
-        base = (self.offset).to_bytes(RECORD_OFFSET_SIZE, byteorder='big') +\
+        return list(encode( self.data, [(0, self.size)], self.offset ))
+
+    def flatten(self, wide=False):
+        base = (self.offset).to_bytes(IPS32_OFFSET_SIZE if wide else RECORD_OFFSET_SIZE, byteorder='big') +\
                (self.size).to_bytes(RECORD_SIZE_SIZE, byteorder='big')
         if self.size:
             return base + self.data
         return base + (self.rle_size).to_bytes(RECORD_SIZE_SIZE, byteorder='big') + self.data
 
+class PatchResult( namedtuple('PatchResult', 'patch output records seconds error') ):
+    '''
+    Outcome of one patch applied by :func:`patch_many`.
+
+    :param patch: Path of the IPS file
+    :param output: Path of the patched file
+    :param records: Number of records applied
+    :param seconds: Wall time spent on this patch
+    :param error: Exception raised while patching, None on success
+    '''
+    pass
+
 class IpsyError(Exception):
     '''
     Logged by :func:`ips_read` when IPS corruption is found.
     '''
     pass
     
-def write( fhpatch, records ):
+class IpsOverlay:
+    '''
+    Sorted, disjoint, byte ranges written by a series of :class:`IpsRecord`.
+    Later records replace whatever earlier records wrote to the same bytes,
+    so the overlay holds exactly what applying every record would write.
+
+    :param records: Iterable of :class:`IpsRecord` to add, in order
+    '''
+
+    def __init__(self, records=()):
+        self.starts, self.chunks = [], []
+        self.overlaps = 0 # Records that wrote over bytes already in the overlay
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, record):
+        '''
+        Lay a record over the ranges already in the overlay.
+
+        :param record: :class:`IpsRecord`
+        '''
+        start, end = record.offset, record.last_byte()
+        if start == end:
+            return
+        data = record.data if record.size else bytes(record.data[:1])*record.rle_size
+        i = bisect_right(self.starts, start) - 1
+        if i < 0 or self.starts[i] + len(self.chunks[i]) <= start:
+            i += 1
+        j = bisect_left(self.starts, end)
+        if i < j:
+            self.overlaps += 1
+        starts, chunks = [start], [data]
+        if i < j and self.starts[i] < start:
+            starts.insert(0, self.starts[i])
+            chunks.insert(0, self.chunks[i][:start-self.starts[i]])
+        if i < j and self.starts[j-1] + len(self.chunks[j-1]) > end:
+            starts.append(end)
+            chunks.append(self.chunks[j-1][end-self.starts[j-1]:])
+        self.starts[i:j], self.chunks[i:j] = starts, chunks
+
+    def extend(self, records):
+        '''
+        Lay several records over the overlay, in order. The records are
+        numbered, sorted by offset once and resolved in a single sweep where
+        the latest record covering a byte wins, so n records cost O(n log n).
+
+        :param records: Iterable of :class:`IpsRecord`
+        '''
+        items = [] # (start, end, sequence, data), the overlay's own ranges come first
+        for seq, r in enumerate(records):
+            start, end = r.offset, r.last_byte()
+            if start != end:
+                items.append((start, end, seq, r.data if r.size else bytes(r.data[:1])*r.rle_size))
+        if not items:
+            return
+        items += [(start, start + len(chunk), -1, chunk) for start, chunk in zip(self.starts, self.chunks)]
+        items.sort(key=itemgetter(0))
+        self.overlaps += _count_overlaps( items )
+        points = sorted(set(map(itemgetter(0), items)).union(map(itemgetter(1), items)))
+        self.starts, self.chunks = [], []
+        active, k, top, since = [], 0, None, 0
+        for p in points:
+            while k < len(items) and items[k][0] == p:
+                start, end, seq, data = items[k]
+                heappush(active, (-seq, end, start, data))
+                k += 1
+            while active and active[0][1] <= p:
+                heappop(active)
+            winner = active[0] if active else None
+            if winner is top:
+                continue
+            if top is not None:
+                self._append(top, since, p)
+            top, since = winner, p
+
+    def _append(self, item, lo, hi):
+        _, end, start, data = item
+        self.starts.append(lo)
+        self.chunks.append(data if lo == start and hi == end else data[lo-start:hi-start])
+
+    def end(self):
+        '''
+        :returns: Offset just past the last byte written, 0 when empty
+        '''
+        return self.starts[-1] + len(self.chunks[-1]) if self.starts else 0
+
+    def spans(self):
+        '''
+        Join touching ranges into contiguous spans.
+
+        :returns: Generator of (offset, data) tuples in offset order
+        '''
+        start, parts, end = 0, [], None
+        for offset, chunk in zip(self.starts, self.chunks):
+            if parts and offset != end:
+                yield start, b''.join(parts)
+                parts = []
+            if not parts:
+                start = offset
+            parts.append(chunk)
+            end = offset + len(chunk)
+        if parts:
+            yield start, b''.join(parts)
+
+    def records(self):
+        '''
+        Non-overlapping :class:`IpsRecord` that write the overlay, one per
+        span unless a span is larger than :data:`MAX_RECORD_SIZE`.
+
+        :returns: Generator of :class:`IpsRecord`
+        '''
+        for offset, data in self.spans():
+            if offset in _FOOTER_OFFSETS:
+                warn("Merged record starts at the 'EOF' offset. " + \
+                    "Provide the destination to avoid this.")
+            yield from _records_from_ranges( data, [(0, len(data))], offset )
+
+def _count_overlaps( items ):
     '''
-    Writes out a list of :class:`IpsRecord` to a file
+    Count the records of an :class:`IpsOverlay` that write over bytes an
+    earlier record, or the overlay itself, already wrote.
+
+    :param items: (start, end, sequence, data) tuples sorted by start, with
+                  a sequence of -1 for ranges already in the overlay
+    :returns: Number of records overlapping an earlier one
+    '''
+    count, i = 0, 0
+    older, newer = [], [] # Ranges begun so far, oldest first, and newest first of those not yet counted
+    while i < len(items):
+        p, j = items[i][0], i
+        while j < len(items) and items[j][0] == p:
+            j += 1
+        group = items[i:j]
+        while older and older[0][1] <= p:
+            heappop(older)
+        first = min(seq for _, _, seq, _ in group)
+        oldest = min(older[0][0], first) if older else first
+        while newer and -newer[0][0] > first:
+            # A later range begun before p and still open is written over here
+            _, end = heappop(newer)
+            count += end > p
+        for _, end, seq, _ in group:
+            heappush(older, (seq, end))
+            if seq >= 0 and oldest < seq:
+                count += 1
+            elif seq >= 0:
+                heappush(newer, (-seq, end))
+        i = j
+    return count
+
+class RecordTable:
+    '''
+    Records stored as columns rather than one :class:`IpsRecord` each. The
+    offset, size and rle_size columns are ``array('I')`` and the data of
+    every record lives in one shared buffer, so a patch with a hundred
+    thousand records is a handful of objects. Indexing or iterating yields
+    :class:`IpsRecord` whose data is a view into that buffer; the table can't
+    grow while any of those views are held.
+
+    :param records: Iterable of :class:`IpsRecord` to copy in, in order
+    '''
+
+    def __init__(self, records=()):
+        self.offsets, self.sizes, self.rle_sizes = array('I'), array('I'), array('I')
+        self.positions = array('Q') # Start of each record's data in self.data
+        self.data = bytearray()
+        self.extend(records)
+
+    @classmethod
+    def _columns(cls, offsets, sizes, rle_sizes, positions, data):
+        table = cls.__new__(cls)
+        table.offsets, table.sizes, table.rle_sizes = offsets, sizes, rle_sizes
+        table.positions, table.data = positions, data
+        return table
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        size = self.sizes[i]
+        start = self.positions[i]
+        return IpsRecord(self.offsets[i], size, self.rle_sizes[i],
+            memoryview(self.data)[start:start+(size or RECORD_RLE_DATA_SIZE)])
+
+    def __iter__(self):
+        view = memoryview(self.data)
+        for offset, size, rle_size, start in zip(self.offsets, self.sizes, self.rle_sizes, self.positions):
+            yield IpsRecord(offset, size, rle_size, view[start:start+(size or RECORD_RLE_DATA_SIZE)])
+
+    def append(self, offset, size, rle_size, data):
+        '''
+        Add one record to the end of the table.
+
+        :param offset: Offset the record is written at
+        :param size: Size of the data, 0 for an RLE record
+        :param rle_size: Number of times an RLE record repeats its value
+        :param data: Bytes-like object, the value of an RLE record first
+        '''
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.rle_sizes.append(rle_size)
+        self.positions.append(len(self.data))
+        self.data += data[:size or RECORD_RLE_DATA_SIZE]
+
+    def extend(self, records):
+        '''
+        Add several records to the end of the table, in order.
+
+        :param records: Iterable of :class:`IpsRecord`
+        '''
+        for r in records:
+            self.append(*r)
+
+    def take(self, order):
+        '''
+        Pick rows by index. The new table shares the data buffer.
+
+        :param order: Iterable of row indexes
+        :returns: :class:`RecordTable`
+        '''
+        order = list(order)
+        return RecordTable._columns(
+            array('I', map(self.offsets.__getitem__, order)),
+            array('I', map(self.sizes.__getitem__, order)),
+            array('I', map(self.rle_sizes.__getitem__, order)),
+            array('Q', map(self.positions.__getitem__, order)), self.data)
+
+    def sort(self):
+        '''
+        Order the rows by offset. The sort is stable, but records that overlap
+        one another no longer apply in their original order unless they
+        start at the same offset.
+
+        :returns: :class:`RecordTable` sharing the data buffer
+        '''
+        return self.take(sorted(range(len(self)), key=self.offsets.__getitem__))
+
+    def last_bytes(self):
+        '''
+        :meth:`IpsRecord.last_byte` of every row.
+
+        :returns: ``array('I')`` of offsets just past each record
+        '''
+        return array('I', map(add, map(add, self.offsets, self.sizes), self.rle_sizes))
+
+    def overlaps(self):
+        '''
+        Find every pair of records that write to a common byte, with a sweep
+        over the rows in offset order.
+
+        :returns: List of (i, j) row index tuples, i < j
+        '''
+        ends, active, pairs = self.last_bytes(), [], []
+        for j in sorted(range(len(self)), key=self.offsets.__getitem__):
+            offset = self.offsets[j]
+            while active and active[0][0] <= offset:
+                heappop(active)
+            if ends[j] == offset:
+                continue
+            pairs.extend((min(i, j), max(i, j)) for _, i in active)
+            heappush(active, (ends[j], j))
+        return sorted(pairs)
+
+    def nbytes(self, wide=False):
+        '''
+        :param wide: Count the 4 byte offsets of IPS32
+        :returns: Size of the records once flattened, without header and footer
+        '''
+        rle = self.sizes.count(0)
+        return len(self)*(LITERAL_COST_32 if wide else LITERAL_COST) + sum(self.sizes) + \
+            rle*(RECORD_SIZE_SIZE + RECORD_RLE_DATA_SIZE)
+
+    def flatten(self, wide=False):
+        '''
+        Serialize every record at once, see :func:`_flatten`.
+
+        :param wide: Use the 4 byte offsets of IPS32
+        :returns: bytearray of the records, without header and footer
+        '''
+        return _flatten( self, wide=wide )
+
+def patch_format( fhpatch ):
+    '''
+    Identify a patch by the magic at the start of the file. The position of
+    the file handler is left where it was.
+
+    :param fhpatch: File handler of the patch
+    :returns: Name of the format from :data:`PATCH_FORMATS`, or None
+    '''
+    start = fhpatch.tell()
+    head = fhpatch.read(max(map(len, PATCH_FORMATS)))
+    fhpatch.seek(start)
+    for magic, name in PATCH_FORMATS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+def write( fhpatch, records, ips32=None ):
+    '''
+    Writes out a list of :class:`IpsRecord` to a file. A list, tuple or
+    :class:`RecordTable` is serialized into one buffer and written in a
+    single call. Anything else is treated as a stream and written
+    :data:`WRITE_BATCH` records at a time, so a generator is never held in
+    memory whole.
 
     :param fhpatch: File handler of the new patch file
-    :param records: List of :class:`IpsRecord`
+    :param records: List of :class:`IpsRecord` or a :class:`RecordTable`
+    :param ips32: True to write an IPS32 patch, with 4 byte offsets, False
+                  for IPS. None picks IPS32 only if a record starts past
+                  :data:`MAX_UNPATCHED`. A stream can't be looked ahead in,
+                  so it is written as IPS until such a record comes, then
+                  what was written is read back and written again as IPS32,
+                  which needs fhpatch to be readable and seekable.
     '''
-    fhpatch.write(b"PATCH")
-    for r in records:
-        fhpatch.write( r.flatten() )
-    fhpatch.write(b"EOF")
+    with _stats.stage('write'):
+        if isinstance(records, (list, tuple, RecordTable)):
+            if ips32 is None:
+                offsets = records.offsets if isinstance(records, RecordTable) else \
+                    (r.offset for r in records)
+                ips32 = max(offsets, default=0) >= MAX_UNPATCHED
+            _write_flat( fhpatch, records, *_FRAMING[ips32], wide=ips32 )
+            return
+        start = fhpatch.tell() if ips32 is None and _rereadable( fhpatch ) else None
+        ips32 = bool(ips32)
+        records, (head, tail) = iter(records), _FRAMING[ips32]
+        while True:
+            batch = list(islice(records, WRITE_BATCH))
+            if not batch:
+                break
+            if start is not None and not ips32 and max(r.offset for r in batch) >= MAX_UNPATCHED:
+                ips32, tail = True, IPS32_FOOTER
+                head = _widen( fhpatch, start, head )
+            _write_flat( fhpatch, batch, head, wide=ips32 )
+            head = b''
+        fhpatch.write(head + tail)
+
+def _rereadable( fh ):
+    try:
+        return fh.readable() and fh.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+def _widen( fhpatch, start, head ):
+    '''
+    Rewrite the records of an IPS patch that :func:`write` has begun, from
+    start, as IPS32.
+
+    :param head: Header not yet written, if nothing has been
+    :returns: Header still to write before the next records
+    '''
+    if head:
+        return IPS32_HEADER
+    fhpatch.seek(start)
+    written = read( BytesIO(fhpatch.read() + b"EOF") )
+    fhpatch.seek(start)
+    fhpatch.truncate()
+    _write_flat( fhpatch, written, IPS32_HEADER, wide=True )
+    return b''
+
+def _write_flat( fhpatch, records, head=b'', tail=b'', wide=False ):
+    data = _flatten( records, head, tail, wide )
+    fhpatch.write(data)
+    _stats.add('write.records', len(records))
+    _stats.add('write.bytes', len(data))
+    _stats.peak('peak_buffer', len(data))
 
-def read( fhpatch, EOFcontinue=False ):
+def _flatten( records, head=b'', tail=b'', wide=False ):
     '''
-    Read in an IPS file to a list of :class:`IpsRecord`
+    Serialize records into one buffer. The exact size is worked out first,
+    then every record header is packed in place and literal data copied
+    straight after it.
+
+    :param records: List of :class:`IpsRecord` or a :class:`RecordTable`
+    :param head: Bytes to put before the records
+    :param tail: Bytes to put after the records
+    :param wide: Pack offsets in 4 bytes, as IPS32 does
+    :returns: bytearray
+    '''
+    if isinstance(records, RecordTable):
+        size, data = records.nbytes(wide), memoryview(records.data)
+        rows = zip(records.offsets, records.sizes, records.rle_sizes, records.positions)
+    else:
+        size, data = sum(map(_cost, records)), None
+        size += len(records)*(LITERAL_COST_32 - LITERAL_COST) if wide else 0
+        rows = records
+    out = bytearray(len(head) + size + len(tail))
+    out[:len(head)] = head
+    pos = len(head)
+    try:
+        for offset, size, rle_size, value in rows:
+            if data is not None:
+                value = data[value:value+(size or RECORD_RLE_DATA_SIZE)]
+            if size and wide:
+                _RECORD_START_32.pack_into(out, pos, offset, size)
+                pos += LITERAL_COST_32
+                out[pos:pos+size] = value
+                pos += size
+            elif size:
+                _RECORD_START.pack_into(out, pos, offset >> 8, offset & 0xff, size)
+                pos += LITERAL_COST
+                out[pos:pos+size] = value
+                pos += size
+            elif wide:
+                _RLE_RECORD_32.pack_into(out, pos, offset, 0, rle_size, value[0])
+                pos += RLE_COST_32
+            else:
+                _RLE_RECORD.pack_into(out, pos, offset >> 8, offset & 0xff, 0, rle_size, value[0])
+                pos += RLE_COST
+    except StructError:
+        raise IpsyError(
+            "Record at offset " + str(offset) + " can't be written to " + ("an IPS32" if wide else "an IPS") + " file")
+    out[pos:] = tail
+    return out
+
+def read( fhpatch, EOFcontinue=False, table=False ):
+    '''
+    Read in an IPS or IPS32 file to a list of :class:`IpsRecord`
 
     :param fhpatch: File handler for IPS patch
     :param EOFcontinue: Continue processing until the real EOF
                         is found (last 3 bytes of file)
-    :returns: List of :class:`IpsRecord`
+    :param table: Return a :class:`RecordTable` whose data buffer is the
+                  patch itself, so no record data is copied
+    :returns: List of :class:`IpsRecord`, or a :class:`RecordTable`
+    '''
+    with _stats.stage('read'):
+        buf = _view( fhpatch )
+        if not table:
+            records = [IpsRecord(offset, size, rle_size, buf[pos:pos+(size or RECORD_RLE_DATA_SIZE)]) \
+                for offset, size, rle_size, pos in _scan( buf, EOFcontinue )]
+        else:
+            offsets, sizes, rle_sizes, positions = array('I'), array('I'), array('I'), array('Q')
+            for offset, size, rle_size, pos in _scan( buf, EOFcontinue ):
+                offsets.append(offset)
+                sizes.append(size)
+                rle_sizes.append(rle_size)
+                positions.append(pos)
+            records = RecordTable._columns(offsets, sizes, rle_sizes, positions, buf)
+    _stats.add('read.records', len(records))
+    _stats.add('read.bytes', len(buf))
+    return records
+
+def iter_records( fhpatch, EOFcontinue=False ):
+    '''
+    Lazily read an IPS or IPS32 file one :class:`IpsRecord` at a time. The patch is
+    memory mapped when possible and the data of each record is a memoryview
+    into it rather than a copy.
+
+    :param fhpatch: File handler for IPS patch
+    :param EOFcontinue: Continue processing until the real EOF
+                        is found (last 3 bytes of file)
+    :returns: Generator of :class:`IpsRecord`
+    '''
+    buf = _view( fhpatch )
+    for offset, size, rle_size, pos in _scan( buf, EOFcontinue ):
+        yield IpsRecord(offset, size, rle_size, buf[pos:pos+(size or RECORD_RLE_DATA_SIZE)])
+
+def _scan( buf, EOFcontinue ):
+    '''
+    Walk the records of an IPS or IPS32 file held in a buffer, telling the
+    two apart by their header.
+
+    :returns: Generator of (offset, size, rle_size, position of the data)
     '''
-    records = []
-    if fhpatch.read(RECORD_HEADER_SIZE) != b"PATCH":
+    wide = buf[:RECORD_HEADER_SIZE] == IPS32_HEADER
+    if buf[:RECORD_HEADER_SIZE] != b"PATCH" and not wide:
         raise IpsyError(
             "IPS file missing header")
-    for offset in iter(partial(fhpatch.read, RECORD_OFFSET_SIZE), b''):
-        if offset == b'EOF':
-            if EOFcontinue:
-                if len(fhpatch.read(MIN_RECORD)) != MIN_RECORD:
-                    break
-                fhpatch.seek(-MIN_RECORD, SEEK_CUR)
-            else:
+    footer = IPS32_FOOTER if wide else b'EOF'
+    offset_size = len(footer)
+    min_record = MIN_RECORD + offset_size - RECORD_OFFSET_SIZE
+    pos, end = RECORD_HEADER_SIZE, len(buf)
+    while pos < end:
+        if buf[pos:pos+offset_size] == footer:
+            if not EOFcontinue or end-pos-offset_size < min_record:
+                pos += offset_size
                 break
-        size = fhpatch.read(RECORD_SIZE_SIZE)
-        if (len(offset) != RECORD_OFFSET_SIZE) or (len(size) != RECORD_SIZE_SIZE):
+        if end-pos < offset_size+RECORD_SIZE_SIZE:
             raise IpsyError(
                 "IPS file unexpectedly ended")
-        offset = int.from_bytes( offset, byteorder='big' )
-        size = int.from_bytes( size, byteorder='big' )
+        if wide:
+            offset, size = _RECORD_START_32.unpack_from(buf, pos)
+        else:
+            high, low, size = _RECORD_START.unpack_from(buf, pos)
+            offset = high << 8 | low
+        pos += offset_size+RECORD_SIZE_SIZE
         if size == 0:
-            size = fhpatch.read(RECORD_SIZE_SIZE)
-            size = int.from_bytes( size, byteorder='big' )
+            if end-pos < RECORD_SIZE_SIZE:
+                raise IpsyError(
+                    "IPS file unexpectedly ended")
+            size, = _RLE_SIZE.unpack_from(buf, pos)
+            pos += RECORD_SIZE_SIZE
             if size == 0:
                 warn("IPS file has record with both 0 size and 0 RLE size." + \
                     "Continuing to next record.")
                 continue
-            data = fhpatch.read(RECORD_RLE_DATA_SIZE)
-            if data == b'':
+            if end-pos < RECORD_RLE_DATA_SIZE:
                 raise IpsyError(
                     "IPS file unexpectedly ended")
-            records.append(IpsRecord(offset, 0, size, data))
+            yield offset, 0, size, pos
+            pos += RECORD_RLE_DATA_SIZE
         else:
-            data = fhpatch.read(size)
-            if len(data) != size:
+            if end-pos < size:
                 raise IpsyError(
                     "IPS file unexpectedly ended")
-            records.append(IpsRecord(offset, size, 0, data))
-    if fhpatch.read(1) != b'':
+            yield offset, size, 0, pos
+            pos += size
+    if pos < end:
         warn("Data after EOF in IPS file. Truncating.")
-    return records
 
-def merge( fhpatch, *fhpatches, path_dst=None ):
+def merge( fhpatch, *fhpatches, path_dst=None, cache=None ):
     '''
     Turns several IPS patches into one larger patch.
     The order that the patches are applied in is preserved.
-    If the destination file is provided then further
-    simplifications can be made.
+    Records are laid over one another in an :class:`IpsOverlay`, so bytes
+    written more than once are only written by the last patch and touching
+    records are combined. If the destination file is provided then further
+    simplifications can be made. The merged patch is IPS32 when any of the
+    patches is, or when it writes past :data:`MAX_UNPATCHED`, or the
+    destination file is larger than that.
 
     :param fhpatch: File Handler for resulting IPS file
     :param fhpatches: list of File Handlers for IPS files to
                       merge
     :param path_dst: Path to file that these patches are
                      intended to be used on.
+    :param cache: :class:`ResultCache` to look the merged patch up in and
+                  store it to
     '''
-    records = [i for s in map(lambda fh:read( fh, EOFcontinue=True ), fhpatches[:-1]) for i in s]
-    if path_dst:
-        records = cleanup_records( records, path_dst )
-    write( fhpatch, records )
+    if cache is not None:
+        digests = [cache.digest( fh ) for fh in fhpatches]
+        if path_dst:
+            digests.append(cache.digest( path_dst ))
+        key = cache.key('merge', digests, destination=bool(path_dst))
+        hit = cache.get( key )
+        if hit is not None:
+            fhpatch.write(hit[0])
+            return
+    with _stats.stage('merge'):
+        ips32 = 'ips32' in map(patch_format, fhpatches)
+        overlay = IpsOverlay(chain.from_iterable(iter_records( fh, EOFcontinue=True ) for fh in fhpatches))
+        _stats.add('merge.overlapping', overlay.overlaps)
+        ips32 = ips32 or overlay.end() > MAX_UNPATCHED
+        if path_dst:
+            ips32 = ips32 or stat(path_dst).st_size > MAX_UNPATCHED
+            records = cleanup_records( RecordTable(overlay.records()), path_dst )
+        else:
+            records = rle_compress( overlay.records() )
+        if cache is None:
+            write( fhpatch, records, ips32 )
+            return
+        merged = BytesIO()
+        write( merged, records, ips32 )
+        cache.put( key, merged.getbuffer() )
+        fhpatch.write(merged.getbuffer())
 
 def cleanup_records( ips_records, path_dst ):
     '''
-    Removes useless records and combines records when possible.
+    Removes useless records and combines records when possible. The
+    destination is read twice side by side, once as it is and once with the
+    records laid over it, and the two are compared with :func:`diff_stream`,
+    so neither is held in memory.
 
-    :param ips_records: List of :class:`IpsRecord`
+    :param ips_records: List of :class:`IpsRecord` or a :class:`RecordTable`
     :param path_dst: Path to file that these patches are intended
                      to be used on.
     :returns: List of :class:`IpsRecord`, simplified where
               possible.
     '''
-    with open(path_dst, 'r') as fh:
-        dstfh = BytesIO(fh.read())
-    srcfh = BytesIO(dstfh.read())
-    patch_from_records( dstfh, ips_records )
-    return diff( srcfh, dstfh, fhpatch=None, rle=True )
+    with _stats.stage('cleanup_records'):
+        overlay = IpsOverlay(ips_records)
+        with open(path_dst, 'rb') as fhsrc, open(path_dst, 'rb') as fhdst:
+            records = list(diff_stream( fhsrc, _PatchedReader( fhdst, overlay ), rle=True ))
+        if not records:
+            warn("No differences found in files")
+        return records
 
 def rle_compress( records ):
     '''
     Attempt to RLE compress a collection of IPS records.
 
-    :param records: List of :class:`IpsRecord` to compress
-    :returns: RLE compressed list of :class:`IpsRecord`
+    :param records: Iterable of :class:`IpsRecord` to compress
+    :returns: Generator of RLE compressed :class:`IpsRecord`
     '''
     # TODO Improve this by compresing RLE records that sandwich a run of the RLE
     # data. Might be more trouble than its worth.  
-    return [i for s in map(lambda r:r.compress(),records) for i in s]
+    stats = _stats.current_stats()
+    if stats is not None:
+        return _counted_compress( records, stats )
+    return chain.from_iterable(map(lambda r:r.compress(), records))
+
+def _counted_compress( records, stats ):
+    '''
+    :func:`rle_compress` while collecting :class:`Stats`.
+    '''
+    for r in records:
+        start = perf_counter()
+        compressed = r.compress()
+        stats.time('rle_compress', perf_counter() - start)
+        stats.add('rle_compress.saved', _cost( r ) - sum(map(_cost, compressed)))
+        yield from compressed
+
+def _cost( r ):
+    '''
+    :returns: Bytes the record takes up in a patch
+    '''
+    return LITERAL_COST + r.size if r.size else RLE_COST
+
+def _remaining( fh ):
+    '''
+    :param fh: Seekable file handler
+    :returns: Number of bytes from the current position to the end of the file
+    '''
+    start = fh.tell()
+    end = fh.seek(0, SEEK_END)
+    fh.seek(start)
+    return max(end - start, 0)
 
-def diff( fhsrc, fhdst, fhpatch=None, rle=False ):
+def _view( fh ):
+    '''
+    Memory map the remainder of a file, from its current position. The map is
+    closed once the returned view, and every slice of it, is released. Falls
+    back to reading the file in when it can't be mapped.
+
+    :param fh: File handler opened for reading
+    :returns: memoryview of the file
+    '''
+    try:
+        mm = mmap(fh.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, OSError, ValueError, UnsupportedOperation):
+        return memoryview(fh.read())
+    return memoryview(mm)[fh.tell():]
+
+@contextmanager
+def _mapped( fh ):
+    '''
+    :func:`_view` as a context manager, releasing the view on exit.
+
+    :param fh: File handler opened for reading
+    :returns: Context manager yielding a memoryview of the file
+    '''
+    view = _view( fh )
+    try:
+        yield view
+    finally:
+        view.release()
+
+def _diff_runs( src, dst, start, stop ):
+    '''
+    Find the runs of differing bytes between two buffers. Equal blocks are
+    skipped with a single comparison, differing blocks are narrowed down to
+    :data:`DIFF_SUB_BLOCK_SIZE` pieces which are XORed and scanned for
+    non-zero runs.
+
+    :returns: Generator of (start, end) tuples, end exclusive, may be adjacent
+    '''
+    for i in range(start, stop, DIFF_BLOCK_SIZE):
+        j = min(i + DIFF_BLOCK_SIZE, stop)
+        if bytes(src[i:j]) == bytes(dst[i:j]):
+            continue
+        for k in range(i, j, DIFF_SUB_BLOCK_SIZE):
+            l = min(k + DIFF_SUB_BLOCK_SIZE, j)
+            a, b = bytes(src[k:l]), bytes(dst[k:l])
+            if a == b:
+                continue
+            xor = int.from_bytes(a, byteorder='big') ^ int.from_bytes(b, byteorder='big')
+            for m in _NONZERO.finditer(xor.to_bytes(l-k, byteorder='big')):
+                yield k + m.start(), k + m.end()
+
+def _diff_ranges( src, dst, start=0, stop=None ):
+    '''
+    Find the ranges where two buffers differ.
+
+    :param src: Bytes-like object of the orignal file
+    :param dst: Bytes-like object of the patched file
+    :param start: First index to compare
+    :param stop: Index to stop comparing at, defaults to the shorter buffer
+    :returns: Generator of (start, end) tuples, end exclusive, never adjacent
+    '''
+    stop = min(len(src), len(dst)) if stop is None else stop
+    return _join_ranges( _diff_runs( src, dst, start, stop ) )
+
+def _join_ranges( runs ):
+    '''
+    Join sorted ranges that touch one another.
+
+    :param runs: Iterable of sorted (start, end) tuples
+    :returns: Generator of (start, end) tuples, never adjacent
+    '''
+    pending = None
+    for lo, hi in runs:
+        if pending and pending[1] == lo:
+            pending = (pending[0], hi)
+            continue
+        if pending:
+            yield pending
+        pending = (lo, hi)
+    if pending:
+        yield pending
+
+def _records_from_ranges( dst, ranges, base=0 ):
+    '''
+    Build :class:`IpsRecord` from the ranges found by :func:`_diff_ranges`.
+    Ranges are split at :data:`MAX_RECORD_SIZE` and any record that would
+    start at the offset b'EOF', or b'EEOF' in IPS32, is moved back a byte to
+    include the previous, unchanged, byte when dst holds it.
+
+    :param dst: Bytes-like object of the patched file
+    :param ranges: Iterable of (start, end) tuples
+    :param base: Offset of the first byte of dst in the file
+    :returns: Generator of :class:`IpsRecord`
+    '''
+    for start, end in ranges:
+        start, end = start + base, end + base
+        while start < end:
+            if start in _FOOTER_OFFSETS and start > base:
+                start -= 1
+            stop = min(end, start + MAX_RECORD_SIZE)
+            yield IpsRecord(start, stop-start, 0, bytes(dst[start-base:stop-base]))
+            start = stop
+
+def _uniform( buf, start, end ):
+    '''
+    True if buf[start:end] is one byte value repeated, compared
+    :data:`DIFF_BLOCK_SIZE` bytes at a time.
+    '''
+    fill = bytes(buf[start:start+1]) * DIFF_BLOCK_SIZE
+    for i in range(start, end, DIFF_BLOCK_SIZE):
+        chunk = buf[i:min(i + DIFF_BLOCK_SIZE, end)]
+        if chunk != fill[:len(chunk)]:
+            return False
+    return True
+
+def _windows( ranges, dst ):
+    '''
+    Group sorted ranges whose gaps are small enough that spanning them might
+    pay off, or that one run of dst covers along with the bytes either side,
+    so a single RLE record can write both ranges.
+
+    :param ranges: Iterable of (start, end) tuples
+    :param dst: Bytes-like object the ranges index into
+    :returns: Generator of lists of (start, end) tuples
+    '''
+    group = []
+    for r in ranges:
+        if group and r[0] - group[-1][1] > MAX_BRIDGE and \
+           not _uniform( dst, group[-1][1]-1, r[0]+1 ):
+            yield group
+            group = []
+        group.append(r)
+    if group:
+        yield group
+
+def _rle_records( offset, size, value ):
+    '''
+    RLE records writing value size times, split at :data:`MAX_RECORD_SIZE`
+    without starting a record at the b'EOF' or b'EEOF' offset.
+    '''
+    while size:
+        n = min(size, MAX_RECORD_SIZE)
+        if n < size and offset + n in _FOOTER_OFFSETS:
+            n -= 1
+        yield IpsRecord(offset, 0, n, value)
+        offset, size = offset + n, size - n
+
+def _encode_window( dst, ranges, base ):
+    '''
+    Cost-optimal segments for one group of changed ranges.
+
+    The window is cut into tokens at every range and run boundary. Each token
+    is either changed (must be written) or unchanged (may be skipped or spanned
+    by a literal). Walking the tokens once, F[k] is the cheapest way to write
+    everything before boundary k with no record open and L[k] the cheapest
+    with a literal still open at k. Runs of at least :data:`MIN_COMPRESS` equal
+    bytes add an RLE edge from their first boundary to their last.
+
+    :returns: List of ('lit' or 'rle', start, end) tuples, indexes into dst
+    '''
+    lo, hi = ranges[0][0], ranges[-1][1]
+    runs = {lo+m.start(): lo+m.end() for m in _RUN.finditer(bytes(dst[lo:hi]))}
+    bounds = sorted(set(chain([lo, hi], chain.from_iterable(ranges),
+                              chain.from_iterable(runs.items()))))
+    index = {b: k for k, b in enumerate(bounds)}
+    inf = float('inf')
+    F, L = [inf]*len(bounds), [inf]*len(bounds)
+    fback, lback = [None]*len(bounds), [None]*len(bounds)
+    F[0], r = 0, 0
+    for k in range(len(bounds)-1):
+        start, end = bounds[k], bounds[k+1]
+        while ranges[r][1] <= start:
+            r += 1
+        changed = ranges[r][0] <= start
+        if start in runs and base+start not in _FOOTER_OFFSETS:
+            j = index[runs[start]]
+            cost = F[k] + RLE_COST*-(-(runs[start]-start)//MAX_RECORD_SIZE)
+            if cost < F[j]:
+                F[j], fback[j] = cost, ('rle', k)
+        L[k+1], lback[k+1] = L[k] + end-start, 'ext'
+        if changed:
+            cost = F[k] + LITERAL_COST + (base+start in _FOOTER_OFFSETS and start > 0)
+            if cost + end-start < L[k+1]:
+                L[k+1], lback[k+1] = cost + end-start, 'open'
+            if L[k+1] < F[k+1]:
+                F[k+1], fback[k+1] = L[k+1], 'close'
+        elif F[k] < F[k+1]:
+            F[k+1], fback[k+1] = F[k], 'skip'
+    segments, k, literal = [], len(bounds)-1, None
+    while k:
+        if literal is None:
+            step = fback[k]
+            if step == 'close':
+                literal = bounds[k]
+            elif step == 'skip':
+                k -= 1
+            else:
+                segments.append(('rle', bounds[step[1]], bounds[k]))
+                k = step[1]
+        else:
+            k -= 1
+            if lback[k+1] == 'open':
+                segments.append(('lit', bounds[k], literal))
+                literal = None
+    segments.reverse()
+    return segments
+
+def encode( dst, ranges, base=0 ):
+    '''
+    Encode the changed ranges of a file as the smallest set of records. Nearby
+    ranges are joined when spanning the unchanged bytes between them is cheaper
+    than another record header, or when a run of equal bytes covers the gap
+    between them, and each stretch is split into RLE and literal records by
+    exact IPS byte cost (splits at :data:`MAX_RECORD_SIZE` aside). Runs in one
+    pass over the changed ranges.
+
+    :param dst: Bytes-like object of the patched file
+    :param ranges: Iterable of sorted (start, end) tuples, indexes into dst,
+                   that have to be written
+    :param base: Offset of the first byte of dst in the file
+    :returns: Generator of :class:`IpsRecord`
+    '''
+    for window in _windows( ranges, dst ):
+        yield from _piece_records( dst, _encode_window( dst, window, base ), base )
+
+def _piece_records( dst, pieces, base ):
+    '''
+    Build the records for the pieces chosen by :func:`_encode_window`.
+    '''
+    for kind, start, end in pieces:
+        if kind == 'lit':
+            yield from _records_from_ranges( dst, [(start, end)], base )
+        else:
+            yield from _rle_records( base+start, end-start, bytes(dst[start:start+1]) )
+
+def block_hashes( path, cache=True ):
+    '''
+    Hash a file :data:`HASH_BLOCK_SIZE` bytes at a time. The hashes are kept
+    next to the file, in its path plus :data:`HASH_SUFFIX`, and reused for
+    as long as the size and modification time of the file are unchanged.
+    A cache that can't be written is simply not kept.
+
+    :param path: Path of the file
+    :param cache: False to neither read nor write the cache
+    :returns: List of digests, one per block
+    '''
+    info = stat(path)
+    header = HASH_MAGIC + _HASH_HEADER.pack(info.st_size, info.st_mtime_ns, HASH_BLOCK_SIZE)
+    if cache:
+        try:
+            with open(path + HASH_SUFFIX, 'rb') as fh:
+                saved = fh.read()
+            count = -(-info.st_size // HASH_BLOCK_SIZE)
+            if saved[:len(header)] == header and \
+               len(saved) == len(header) + count*HASH_DIGEST_SIZE:
+                return [saved[i:i+HASH_DIGEST_SIZE] for i in range(len(header), len(saved), HASH_DIGEST_SIZE)]
+        except OSError:
+            pass
+    from hashlib import sha256
+    with open(path, 'rb') as fh, _mapped(fh) as buf:
+        hashes = [sha256(buf[i:i+HASH_BLOCK_SIZE]).digest() \
+            for i in range(0, len(buf), HASH_BLOCK_SIZE)]
+    if cache:
+        temp = path + HASH_SUFFIX + '.' + str(getpid())
+        try:
+            with open(temp, 'wb') as fh:
+                fh.write(header + b''.join(hashes))
+            replace(temp, path + HASH_SUFFIX)
+        except OSError:
+            pass
+    return hashes
+
+def _hashed_ranges( fhsrc, fhdst, src, dst ):
+    '''
+    Find the ranges where two files differ by comparing only the blocks
+    whose hashes differ, see :func:`block_hashes`. The hashes of fhsrc are
+    cached, those of fhdst are worked out each time.
+
+    :returns: Generator of (start, end) tuples, or None if either file isn't
+              a named file read from its start
+    '''
+    try:
+        if fhsrc.tell() or fhdst.tell():
+            return None
+        old, new = block_hashes( fhsrc.name ), block_hashes( fhdst.name, cache=False )
+    except (AttributeError, TypeError, OSError, UnsupportedOperation):
+        return None
+    stop = min(len(src), len(dst))
+    blocks = (k*HASH_BLOCK_SIZE for k in range(-(-stop // HASH_BLOCK_SIZE)) \
+        if old[k:k+1] != new[k:k+1])
+    return _join_ranges( chain.from_iterable( \
+        _diff_runs( src, dst, i, min(i+HASH_BLOCK_SIZE, stop) ) for i in blocks ))
+
+def diff( fhsrc, fhdst, fhpatch=None, rle=False, table=False, workers=1, hashed=False,
+          cache=None, ips32=None ):
     '''
     Diff two files, attempt RLE compression, and write the IPS patch to a file.
-    Assumes both files are the same size.
+    With RLE the records come from :func:`encode`, otherwise every changed
+    range gets its own literal record.
+    Assumes both files are the same size. Both files are compared a block at a
+    time; the target is a 16 MiB pair with sparse changes in well under a
+    second and a completely different 16 MiB pair in about a second.
+    Files that can't seek, e.g. pipes, are compared by :func:`diff_stream`
+    instead, without workers, hashes or cache.
 
     :param fhsrc: File handler of orignal file
     :param fhdst: File handler of the patched file
     :param fhpatch: File handler for IPS file
     :param rle: True if RLE compression should be used
+    :param table: Collect the records in a :class:`RecordTable`
+    :param workers: Number of processes to spread the work over, None for one
+                    per core. See :func:`_diff_parallel`, the patch is the same
+                    either way.
+    :param hashed: Only compare the blocks whose hashes differ, with the
+                   hashes of fhsrc cached next to it. See :func:`block_hashes`.
+                   Used instead of workers. The patch is the same either way.
+    :param cache: :class:`ResultCache` to look the patch up in and store it to
+    :param ips32: True to write an IPS32 patch, False for IPS. None picks
+                  IPS32 when the patched file is larger than
+                  :data:`MAX_UNPATCHED`, or for a stream when a record
+                  starts past it. The records are the same either way.
     
-    :returns: List of :class:`IpsRecord` that were written to the file.
-    '''
-    records, patch_bytes  = [], b''
-    for src_byte in iter(partial(fhsrc.read, 1), b''):
-        dst_byte = fhdst.read(1)
-        s = len(patch_bytes)
-        if (src_byte == dst_byte) or (s == MAX_RECORD_SIZE):
-            if s != 0:
-                offset = fhdst.tell()-s-1
-                if offset.to_bytes(RECORD_OFFSET_SIZE, byteorder='big') == b'EOF':
-                    offset, s = offset-1, s+1
-                    fhsrc.seek(offset)
-                    patch_bytes = fhsrc.read(s)
-                records.append(IpsRecord(fhdst.tell()-s-1, s, 0, patch_bytes[:]))
-            patch_bytes = b''
+    :returns: List of :class:`IpsRecord` that were written to the file, or
+              a :class:`RecordTable` of them.
+    '''
+    streamed = not (fhsrc.seekable() and fhdst.seekable())
+    base = 0 if streamed else fhdst.tell()
+    if ips32 is None and not streamed:
+        ips32 = base + _remaining( fhdst ) > MAX_UNPATCHED
+    cache = None if streamed else cache
+    if cache is not None:
+        key = cache.key('diff', [cache.digest( fhsrc ), cache.digest( fhdst )], rle=rle, base=base,
+                        ips32=ips32)
+        hit = cache.get( key )
+        if hit is not None:
+            records = read( BytesIO(hit[0]), table=table )
+            if len(records) == 0:
+                warn("No differences found in files")
+            if fhpatch:
+                fhpatch.write(hit[0])
+            return records
+    collect = RecordTable if table else list
+    records = None
+    with _stats.stage('diff'):
+        if streamed:
+            records = diff_stream( fhsrc, fhdst, rle )
+        elif workers != 1 and not hashed:
+            records = _diff_parallel( fhsrc, fhdst, rle, workers )
+        if records is not None:
+            records = collect(records)
         else:
-            patch_bytes += dst_byte
-    s = len(patch_bytes)
-    if s != 0:
-        records.append(IpsRecord(fhdst.tell()-s, s, 0, patch_bytes[:]))
+            with _mapped(fhsrc) as src, _mapped(fhdst) as dst:
+                _stats.add('diff.bytes', min(len(src), len(dst)))
+                ranges = _hashed_ranges( fhsrc, fhdst, src, dst ) if hashed else None
+                if ranges is None:
+                    ranges = _diff_ranges( src, dst )
+                if rle:
+                    records = collect(encode( dst, ranges, base ))
+                else:
+                    records = collect(_records_from_ranges( dst, ranges, base ))
+    _stats.add('diff.records', len(records))
     if len(records) == 0:
         warn("No differences found in files")
-    if rle:
-        records = rle_compress( records )
-    if fhpatch:
-        write( fhpatch, records )
+    if cache is not None:
+        data = _flatten( records, *_FRAMING[ips32], wide=ips32 )
+        cache.put( key, data, len(records) )
+        if fhpatch:
+            fhpatch.write(data)
+    elif fhpatch:
+        write( fhpatch, records, ips32 )
     return records
 
-def patch_from_records( fhdest, records ):
+def _read_exactly( fh, size ):
+    '''
+    Read size bytes, fewer only at the end of the stream. Raw files and
+    pipes may return less than they are asked for.
+    '''
+    data = fh.read(size)
+    while 0 < len(data) < size:
+        more = fh.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def diff_stream( fhsrc, fhdst, rle=False, window=DIFF_STREAM_WINDOW ):
+    '''
+    Diff two streams, e.g. pipes, without seeking either of them or holding
+    them in memory. Both are read window bytes at a time and offsets are
+    counted from where they start. Changed ranges are kept until nothing
+    later in the stream can join them, then turned into records exactly as
+    :func:`diff` would, along with the byte before them so a record at the
+    b'EOF' offset can still be moved back onto it. A stretch of changes
+    longer than a window is cut, without RLE at a :data:`MAX_RECORD_SIZE`
+    boundary, so the records are still those of :func:`diff`, with RLE
+    wherever it reached, which costs a record header or so. Peak memory is a
+    few windows whatever the size of the files.
+    Stops at the end of the shorter stream.
+
+    :param fhsrc: File handler of orignal file, opened for reading bytes
+    :param fhdst: File handler of the patched file, opened for reading bytes
+    :param rle: True if RLE compression should be used
+    :param window: Bytes of each stream read at a time
+    :returns: Generator of :class:`IpsRecord` in offset order, ready for
+              :func:`write`
+    '''
+    pending, carry, carry_start, offset = [], b'', 0, 0
+    build = encode if rle else _records_from_ranges
+    while True:
+        src, dst = _read_exactly( fhsrc, window ), _read_exactly( fhdst, window )
+        n = min(len(src), len(dst))
+        _stats.add('diff.bytes', n)
+        for start, end in _diff_ranges( src, dst, 0, n ):
+            if pending and pending[-1][1] == start + offset:
+                pending[-1] = (pending[-1][0], end + offset)
+            else:
+                pending.append((start + offset, end + offset))
+        data, offset, done = carry + dst[:n], offset + n, n < window
+        # Ranges close once no later change can join them, or their group with RLE
+        closed, reach, gap = len(pending), offset, MAX_BRIDGE if rle else 0
+        while not done and closed and (reach - pending[closed-1][1] <= gap or
+              rle and _uniform( data, pending[closed-1][1]-1-carry_start, reach+1-carry_start )):
+            closed -= 1
+            reach = pending[closed][0]
+        # Cut a stretch of changes that has outgrown the window
+        cut = closed < len(pending) and offset - pending[closed][0] > window
+        if cut and rle:
+            closed = len(pending)
+        if closed:
+            yield from build( data, [(start-carry_start, end-carry_start) for start, end in pending[:closed]],
+                              carry_start )
+            del pending[:closed]
+        if cut and not rle:
+            start, end = pending[0]
+            records = list(_records_from_ranges( data, [(start-carry_start, end-carry_start)], carry_start ))
+            yield from records[:-1]
+            pending[0] = (records[-1].offset, end)
+        if done:
+            return
+        # A cut record moved back onto b'EOF' may already start at carry_start
+        keep = max((pending[0][0] if pending else offset) - 1, carry_start)
+        carry, carry_start = data[keep-carry_start:], keep
+
+class _PatchedReader:
+    '''
+    Stream of a file as it would be with an :class:`IpsOverlay` applied,
+    read without copying or changing the file. Ends where the file does.
+
+    :param fh: File handler of the unpatched file
+    :param overlay: :class:`IpsOverlay`
     '''
-    Apply an list of :class:`IpsRecord` to a file. Destructive processes.
+
+    def __init__(self, fh, overlay):
+        self.fh, self.overlay, self.k, self.pos = fh, overlay, 0, 0
+
+    def read(self, size):
+        data = bytearray(self.fh.read(size))
+        start, stop = self.pos, self.pos + len(data)
+        starts, chunks = self.overlay.starts, self.overlay.chunks
+        while self.k < len(starts) and starts[self.k] < stop:
+            offset, chunk = starts[self.k], chunks[self.k]
+            lo, hi = max(offset, start), min(offset + len(chunk), stop)
+            data[lo-start:hi-start] = chunk[lo-offset:hi-offset]
+            if offset + len(chunk) > stop:
+                break
+            self.k += 1
+        self.pos = stop
+        return bytes(data)
+
+_diff_state = {} # Buffers of the files a diff worker was started for
+
+def _diff_init( fdsrc, possrc, fddst, posdst ):
+    '''
+    Start a :func:`_diff_parallel` worker by mapping both files.
+    '''
+    _diff_state['src'] = memoryview(mmap(fdsrc, 0, access=ACCESS_READ))[possrc:]
+    _diff_state['dst'] = memoryview(mmap(fddst, 0, access=ACCESS_READ))[posdst:]
+
+def _diff_chunk( chunk ):
+    '''
+    Worker for :func:`_diff_parallel`, find the changed ranges in one chunk.
+    '''
+    return list(_diff_ranges( _diff_state['src'], _diff_state['dst'], *chunk ))
+
+def _encode_group( job ):
+    '''
+    Worker for :func:`_diff_parallel`, split a group of windows into pieces.
+    '''
+    windows, base = job
+    dst = _diff_state['dst']
+    return list(chain.from_iterable(_encode_window( dst, w, base ) for w in windows))
+
+def _diff_parallel( fhsrc, fhdst, rle, workers ):
+    '''
+    Diff two files across a pool of processes, each mapping both files. The
+    files are split into block aligned chunks and the changed ranges of every
+    chunk are found in parallel. Ranges that meet at a chunk edge are joined
+    again. With RLE the ranges are then cut into groups wherever
+    :func:`encode` would start a new window anyway, and the groups are
+    encoded in parallel. As no record can cross a cut, the records are
+    exactly those of a serial diff. The records themselves are built here,
+    from this process's own map of fhdst, so only offsets cross processes.
+
+    :returns: List of :class:`IpsRecord`, or None if the files can't be mapped
+    '''
+    from multiprocessing import get_all_start_methods, get_context
+    if 'fork' not in get_all_start_methods():
+        return None
+    try:
+        fdsrc, fddst = fhsrc.fileno(), fhdst.fileno()
+        possrc, base = fhsrc.tell(), fhdst.tell()
+        with mmap(fdsrc, 0, access=ACCESS_READ) as src, mmap(fddst, 0, access=ACCESS_READ) as dst:
+            size = max(min(len(src) - possrc, len(dst) - base), 0)
+    except (AttributeError, OSError, ValueError, UnsupportedOperation):
+        return None
+    _stats.add('diff.bytes', size)
+    workers = workers or cpu_count() or 1
+    with get_context('fork').Pool(workers, _diff_init, (fdsrc, possrc, fddst, base)) as pool:
+        tasks = workers * DIFF_TASKS_PER_WORKER
+        step = -(-size // tasks // DIFF_BLOCK_SIZE) * DIFF_BLOCK_SIZE or DIFF_BLOCK_SIZE
+        chunks = [(i, min(i+step, size)) for i in range(0, size, step)]
+        ranges = list(_join_ranges( chain.from_iterable(pool.map(_diff_chunk, chunks)) ))
+        if not rle:
+            with _mapped(fhdst) as dst:
+                return list(_records_from_ranges( dst, ranges, base ))
+        share = sum(end-start for start, end in ranges) // tasks + 1
+        groups, group, weight = [], [], 0
+        with _mapped(fhdst) as dst:
+            for window in _windows( ranges, dst ):
+                group.append(window)
+                weight += window[-1][1] - window[0][0]
+                if weight >= share:
+                    groups.append((group, base))
+                    group, weight = [], 0
+        if group:
+            groups.append((group, base))
+        pieces = chain.from_iterable(pool.map(_encode_group, groups))
+        with _mapped(fhdst) as dst:
+            return list(_piece_records( dst, pieces, base ))
+
+def _apply_order( records ):
+    '''
+    Order records by offset. Records that overlap one another are kept
+    together, in their original order, so later records still win.
+
+    :param records: List of :class:`IpsRecord` or a :class:`RecordTable`
+    :returns: Generator of :class:`IpsRecord`
+    '''
+    if isinstance(records, RecordTable):
+        offsets, ends = records.offsets, records.last_bytes()
+    else:
+        offsets = [r.offset for r in records]
+        ends = [r.last_byte() for r in records]
+    cluster, end = [], 0
+    for i in sorted(range(len(records)), key=offsets.__getitem__):
+        if cluster and offsets[i] >= end:
+            if len(cluster) > 1:
+                _stats.add('patch.overlapping', len(cluster))
+            yield from (records[j] for j in sorted(cluster))
+            cluster = []
+        end = max(end, ends[i]) if cluster else ends[i]
+        cluster.append(i)
+    if len(cluster) > 1:
+        _stats.add('patch.overlapping', len(cluster))
+    yield from (records[j] for j in sorted(cluster))
+
+def _payload( r, fills ):
+    '''
+    Bytes written by a record. RLE records are served as a view of a cached
+    run of their value, so nothing is built per record.
+
+    :param r: :class:`IpsRecord`
+    :param fills: dict of byte value to memoryview, shared between calls
+    :returns: Bytes-like object
+    '''
+    if r.size:
+        return r.data
+    value = r.data[0]
+    if value not in fills:
+        fills[value] = memoryview(bytes([value])*MAX_RECORD_SIZE)
+    return fills[value][:r.rle_size]
+
+def _patch_mapped( fhdest, records ):
+    '''
+    Apply records through a writable memory map of the whole file, growing
+    the file first if a record writes past its end.
+
+    :returns: False if the file can't be mapped, otherwise True
+    '''
+    try:
+        fhdest.fileno()
+    except (AttributeError, OSError, UnsupportedOperation):
+        return False
+    fhdest.flush()
+    end = max(records.last_bytes() if isinstance(records, RecordTable) else \
+        (r.last_byte() for r in records))
+    fhdest.seek(0, SEEK_END)
+    if fhdest.tell() < end:
+        fhdest.truncate(end)
+    try:
+        mm = mmap(fhdest.fileno(), 0)
+    except (OSError, ValueError):
+        return False
+    with mm:
+        _patch_buffer( mm, records )
+    return True
+
+def _patch_buffer( buf, records ):
+    '''
+    Apply records to a writable buffer that is already large enough.
+    '''
+    fills = {}
+    for r in _apply_order( records ):
+        buf[r.offset:r.last_byte()] = _payload( r, fills )
+
+def _patch_buffered( fhdest, records ):
+    '''
+    Apply records in offset order, joining records that continue one another
+    into a single write.
+    '''
+    fills, parts, start, pos = {}, [], 0, 0
+    for r in _apply_order( records ):
+        if parts and r.offset != pos:
+            fhdest.seek(start)
+            fhdest.write(b''.join(parts))
+            parts = []
+        if not parts:
+            start = r.offset
+        parts.append(_payload( r, fills ))
+        pos = r.last_byte()
+    if parts:
+        fhdest.seek(start)
+        fhdest.write(b''.join(parts))
+
+def _undo_records( fhdest, records ):
+    '''
+    Records that put back every byte the given records are about to
+    overwrite. The ranges written are joined into disjoint spans first, so
+    overlapping records are read once, before any of them is applied, and
+    the spans are then read in a single pass in offset order, through a
+    memory map of the file when it can be mapped. The records are chosen by
+    :func:`encode`, so runs come out RLE compressed. Bytes written past the
+    end of the file have nothing to be put back to and are left out.
+
+    :param fhdest: File handler about to be patched
+    :param records: List of :class:`IpsRecord` or a :class:`RecordTable`
+    :returns: List of :class:`IpsRecord`
+    '''
+    if isinstance(records, RecordTable):
+        spans = sorted(zip(records.offsets, records.last_bytes()))
+    else:
+        spans = sorted((r.offset, r.last_byte()) for r in records)
+    fhdest.flush()
+    try:
+        buf = mmap(fhdest.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, OSError, ValueError, UnsupportedOperation):
+        buf = None
+    size = len(buf) if buf is not None else fhdest.seek(0, SEEK_END)
+    ranges = []
+    for start, end in spans:
+        end = min(end, size)
+        if start >= end:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    _stats.add('undo.bytes', sum(end-start for start, end in ranges))
+    if buf is not None:
+        with buf:
+            return list(encode( buf, ranges ))
+    undo = []
+    for start, end in ranges:
+        # Read a byte early, a span at the b'EOF' offset is moved back onto it
+        lo = max(start-1, 0)
+        fhdest.seek(lo)
+        undo.extend(encode( fhdest.read(end-lo), [(start-lo, end-lo)], lo ))
+    return undo
+
+def patch_from_records( fhdest, records, mapped=False, fhundo=None ):
+    '''
+    Apply an iterable of :class:`IpsRecord` to a file. Destructive processes.
 
     :param fhdest: File handler to-be-patched
-    :param fhpatch: File handler of the patch
+    :param records: Iterable of :class:`IpsRecord` or a :class:`RecordTable`
+    :param mapped: Memory map the file and apply all records at once, in
+                   offset order. Files that can't be mapped (pipes, BytesIO)
+                   get buffered, coalesced, writes instead.
+    :param fhundo: File handler to write an undo patch to, one that puts
+                   back the bytes the records overwrite, see
+                   :func:`_undo_records`. Every record is read before
+                   anything is written. A patch that makes the file larger
+                   can't be fully undone, the file keeps its new size.
 
     :returns: Number of records applied by the patch
     '''
-    for r in records:
-        fhdest.seek(r.offset)
-        fhdest.write(r.inflate().data)
-    return len(records)
+    undo = None
+    if fhundo is not None:
+        if not isinstance(records, RecordTable):
+            records = list(records)
+        with _stats.stage('undo'):
+            undo = _undo_records( fhdest, records )
+    with _stats.stage('patch'):
+        if mapped:
+            if not isinstance(records, RecordTable):
+                records = list(records)
+            if records and not _patch_mapped( fhdest, records ):
+                _patch_buffered( fhdest, records )
+            count = len(records)
+            if _stats.current_stats() is not None:
+                _stats.add('patch.bytes', sum(r.size or r.rle_size for r in records))
+        else:
+            count = written = 0
+            for count, r in enumerate(records, 1):
+                fhdest.seek(r.offset)
+                fhdest.write(r.inflate().data)
+                written += r.size or r.rle_size
+            _stats.add('patch.bytes', written)
+    _stats.add('patch.records', count)
+    if undo is not None:
+        write( fhundo, undo )
+    return count
 
-def patch( fhdest, fhpatch, EOFcontinue=False ):
+def patch( fhdest, fhpatch, EOFcontinue=False, mapped=False, fhmerged=None, fhundo=None ):
     '''
-    Apply an IPS patch to a file. Destructive processes.
+    Apply an IPS or IPS32 patch to a file. Destructive processes. Records are applied
+    as they are read, so a corrupt patch may leave the file partly patched.
+
+    Given a list of patches they are stacked, in order, into one
+    :class:`IpsOverlay` first, so every byte is written once, in offset order,
+    no matter how many patches touch it.
 
     :param fhdest: File handler to-be-patched
-    :param fhpatch: File handler of the patch
+    :param fhpatch: File handler of the patch, or a list of them
     :param EOFcontinue: Continue processing until the real EOF
                         is found (last 3 bytes of file)
-    :returns: Number of records applied by the patch
+    :param mapped: See :func:`patch_from_records`. The whole patch is read
+                   before anything is written.
+    :param fhmerged: File handler to also write the stacked patches to, as
+                     :func:`merge` would, IPS32 if it has to be. Only used
+                     with a list of patches.
+    :param fhundo: File handler to write an undo patch to, see
+                   :func:`patch_from_records`
+    :returns: Number of records applied by the patch, for a list the number
+              of contiguous spans written
     '''
-    return patch_from_records( fhdest, read( fhpatch, EOFcontinue ) )
-    
-#from zlib import crc32
-#from shutil import copyfileobj
-#from os import SEEK_END, SEEK_SET
-#from tempfile import TemporaryFile
-#
-#class UPS:
-#
-#    RECORD_HEADER_SIZE = 4
-#
-#    class UpsRecord( namedtuple('UpsRecord', 'skip xor') ):
-#        pass
-#        
-#    def crc_check( fhpatch, fhsrc, fhdst ):
-#        crcSrc, crcDst = crc32(fhsrc), crc32(fhdst)
-#        crcPat = crc32(fhpatch, ignorelast32=True)
-#        fhpatch.seek(-12, SEEK_END)
-#        fcrcSrc, fcrcDst, fcrcPat = list(iter(partial(fhpatch.read, 4), b''))
-#        # Do compare
-#        
-#    def read( fhpatch ):
-#        if fhpatch.read(RECORD_HEADER_SIZE) != b"UPS1":
-#            raise IpsyError(
-#                "UPS file missing header")
-#        fhpatch.seek(-12, SEEK_END)
-#        list(iter(partial(fhpatch.read, 4), b''))
-#        ## OTher stuff
-#
-#    def varaible_int_read( fhpatch ):
-#        result, shift = 0, 0
-#        for chunk in iter(partial(fhpatch.read, 1), b''):
-#            chunk = int.from_bytes( chunk, byteorder='big' )
-#            if chunk & 0x80:
-#                result += (chunk & 0x7f) << shift
-#                break
-#            result += (chunk | 0x80) << shift
-#            shift += 7
-#        return result
-#
-#    def crc32( fh, ignorelast32=False ):
-#        fh = strip_crc32(fh) if ignorelast32 else fh
-#        out = 0
-#        for chunk in iter(partial(fh.read, 16384), b''):
-#            out = zlib.crc32(chunk, out)
-#        return out & 0xFFFFFFFF
-#
-#    # This is a bad idea for big files
-#    def strip_crc32( fh ):
-#        copyfh = TemporaryFile()
-#        copyfileobj(fh, copyfh, size)
-#        copyfh.seek(-4, SEEK_END)
-#        copyfh.truncate()
+    if not isinstance(fhpatch, (list, tuple)):
+        return patch_from_records( fhdest, iter_records( fhpatch, EOFcontinue ), mapped, fhundo )
+    ips32 = 'ips32' in map(patch_format, fhpatch)
+    overlay = IpsOverlay(chain.from_iterable(iter_records( fh, EOFcontinue ) for fh in fhpatch))
+    _stats.add('patch.overlapping', overlay.overlaps)
+    if fhmerged:
+        write( fhmerged, rle_compress( overlay.records() ), ips32 or overlay.end() > MAX_UNPATCHED )
+    return patch_from_records( fhdest, (IpsRecord(offset, len(data), 0, data) \
+        for offset, data in overlay.spans()), mapped, fhundo )
+
+def _patch_job( job ):
+    '''
+    Worker for :func:`patch_many`. Never raises, errors are returned. The new
+    file is written next to the output and moved over it once complete, so
+    an output that is also an input is never truncated while it's read.
+    '''
+    path_unpatched, path_patch, path_output, EOFcontinue, mapped = job
+    start, count = perf_counter(), 0
+    temp = path_output + '.' + str(getpid())
+    try:
+        with open(path_patch, 'rb') as fhpatch:
+            if patch_format( fhpatch ) in ('bps', 'ups'):
+                from .bps import bps_patch
+                from .ups import ups_patch
+                apply = bps_patch if patch_format( fhpatch ) == 'bps' else ups_patch
+                with open(path_unpatched, 'rb') as fhsrc, open(temp, 'w+b') as fhdest:
+                    count = apply( fhsrc, fhpatch, fhdest )
+                replace(temp, path_output)
+                return PatchResult(path_patch, path_output, count, perf_counter()-start, None)
+            records = read( fhpatch, EOFcontinue )
+        count = len(records)
+        if not mapped:
+            copyfile( path_unpatched, temp )
+            with open(temp, 'r+b') as fhdest:
+                patch_from_records( fhdest, records )
+        else:
+            with _stats.stage('patch'):
+                end = max((r.last_byte() for r in records), default=0)
+                with open(path_unpatched, 'rb') as fhsrc:
+                    try:
+                        buf = mmap(fhsrc.fileno(), 0, access=ACCESS_COPY)
+                    except ValueError:
+                        buf = bytearray()
+                    if len(buf) < end:
+                        buf = bytearray(buf)
+                        buf.extend(bytes(end-len(buf)))
+                        _stats.peak('peak_buffer', len(buf))
+                _patch_buffer( buf, records )
+                with open(temp, 'wb') as fhout:
+                    fhout.write(buf)
+            _stats.add('patch.records', count)
+        replace(temp, path_output)
+    except Exception as e:
+        try:
+            remove(temp)
+        except OSError:
+            pass
+        return PatchResult(path_patch, path_output, count, perf_counter()-start, e)
+    return PatchResult(path_patch, path_output, count, perf_counter()-start, None)
+
+def patch_many( path_unpatched, jobs, EOFcontinue=False, mapped=True, workers=None, cache=None ):
+    '''
+    Apply many IPS (or BPS, UPS) patches to the same unpatched file, each producing
+    its own output file, across several processes. Every job maps the unpatched file
+    copy-on-write, so the base is shared through the page cache and only the
+    pages a patch touches are copied, then writes its result in one call.
+    A failing patch doesn't stop the others.
+
+    :param path_unpatched: Path to the unpatched file
+    :param jobs: Iterable of (path to IPS file, path to new file) tuples
+    :param EOFcontinue: Continue processing until the real EOF
+                        is found (last 3 bytes of file)
+    :param mapped: False to copy the unpatched file and apply records one at
+                   a time instead
+    :param workers: Number of processes, defaults to one per core. With 1
+                    the patches are applied in this process.
+    :param cache: :class:`ResultCache`. Patched files found in it are copied
+                  out instead of being patched, the rest are stored to it.
+    :returns: List of :class:`PatchResult` in the order of jobs
+    '''
+    jobs = [(path_unpatched, ips, out, EOFcontinue, mapped) for ips, out in jobs]
+    results, keys = [None]*len(jobs), [None]*len(jobs)
+    if cache is not None:
+        base = cache.digest( path_unpatched )
+        for i, job in enumerate(jobs):
+            start = perf_counter()
+            keys[i] = cache.key('patch', [base, cache.digest( job[1] )], EOFcontinue=EOFcontinue)
+            count = cache.get_file( keys[i], job[2] )
+            if count is not None:
+                results[i] = PatchResult(job[1], job[2], count, perf_counter()-start, None)
+    todo = [i for i, result in enumerate(results) if result is None]
+    if workers == 1 or len(todo) < 2:
+        done = [_patch_job( jobs[i] ) for i in todo]
+    else:
+        from multiprocessing import get_all_start_methods, get_context
+        method = 'fork' if 'fork' in get_all_start_methods() else None
+        with get_context(method).Pool(workers) as pool:
+            done = pool.map(_patch_job, [jobs[i] for i in todo], chunksize=1)
+    for i, result in zip(todo, done):
+        results[i] = result
+        if cache is not None and not result.error:
+            cache.put( keys[i], result.output, result.records )
+    return results
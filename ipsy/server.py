@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import cpu_count, path as ospath
+from time import perf_counter
+from urllib.parse import urlsplit, parse_qs
+from .ipsy import IpsyError, read, patch_from_records
+from .checksum import VERIFY_ALGORITHMS
+from .cache import ROM_CACHE_SIZE, RomCache
+
+__all__ = ['SERVER_CACHE_SIZE', 'SERVER_MAX_CONNECTIONS', 'RomCache', 'PatchServer', 'serve']
+
+SERVER_CACHE_SIZE = ROM_CACHE_SIZE # Bytes of base ROMs kept in memory by default
+SERVER_MAX_BODY = 2**26   # Largest patch accepted, bytes
+SERVER_MAX_PENDING = 64   # Requests waiting or running before new ones are turned away
+SERVER_MAX_CONNECTIONS = 256 # Connections open at once before new ones are turned away
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # Seconds
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class _Histogram:
+    '''
+    Counts of observations at or under each of :data:`LATENCY_BUCKETS`.
+    '''
+
+    def __init__(self):
+        self.counts, self.sum = [0]*(len(LATENCY_BUCKETS)+1), 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.counts):
+            total += count
+            yield name + '_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(total)
+        yield name + '_sum{' + labels + '} ' + repr(self.sum)
+        yield name + '_count{' + labels + '} ' + str(total)
+
+class PatchServer:
+    '''
+    Long running HTTP service that applies IPS patches to base ROMs kept in
+    a :class:`RomCache`, so a request pays for neither interpreter startup
+    nor reading the ROM. Patches are parsed with :func:`read` and applied
+    with :func:`patch_from_records` in a pool of threads; the event loop
+    only moves bytes.
+
+    - ``POST /patch?base=NAME`` with the patch as the body answers with the
+      patched ROM. Add ``hash=crc32``, ``md5`` or ``sha1`` for a JSON object
+      with the checksum instead, and ``eof=1`` to read the patch as with
+      ``-eof``. NAME is a path under roms_dir.
+    - ``GET /metrics`` answers with counters, the ROM cache and latency
+      histograms, in the Prometheus text format.
+
+    At most max_requests patches are applied at once. Requests past that
+    wait, and once max_pending are waiting or running new ones are answered
+    with 503 before their body is read, so a burst can't queue, or hold
+    patches in memory, without bound. Connections past max_connections are
+    answered with 503 and closed. Responses are only written as fast as the
+    client reads them.
+
+    :param roms_dir: Directory holding the base ROMs
+    :param workers: Number of threads applying patches, None for one per core
+    :param cache_size: Bytes of base ROMs kept in memory
+    :param max_requests: Patches applied at once, defaults to workers
+    :param max_pending: Requests waiting or running before new ones are refused
+    :param max_connections: Connections open at once before new ones are refused
+    '''
+
+    def __init__(self, roms_dir, workers=None, cache_size=SERVER_CACHE_SIZE, max_requests=None,
+                 max_pending=SERVER_MAX_PENDING, max_connections=SERVER_MAX_CONNECTIONS):
+        self.roms_dir = ospath.realpath(roms_dir)
+        self.workers = workers or cpu_count() or 1
+        self.cache = RomCache(cache_size)
+        self.slots = asyncio.Semaphore(max_requests or self.workers)
+        self.max_pending, self.pending = max_pending, 0
+        self.max_connections, self.connections = max_connections, 0
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.latency, self.responses = {}, {}
+
+    def _rom_path(self, name):
+        path = ospath.realpath(ospath.join(self.roms_dir, name))
+        if not path.startswith(self.roms_dir + ospath.sep) or not ospath.isfile(path):
+            return None
+        return path
+
+    def _apply(self, path, body, EOFcontinue, algorithm):
+        '''
+        Work done in the pool for one patch request.
+
+        :returns: Patched ROM as bytes, or its hex digest if algorithm is given
+        '''
+        fhdest = BytesIO(self.cache.get(path))
+        patch_from_records( fhdest, read( BytesIO(body), EOFcontinue ), mapped=True )
+        if not algorithm:
+            return fhdest.getvalue()
+        hasher = VERIFY_ALGORITHMS[algorithm]()
+        hasher.update(fhdest.getbuffer())
+        return hasher.hexdigest()
+
+    async def _patch(self, query, body):
+        '''
+        :param body: Coroutine function reading the request body, only called
+                     once the request has a pending slot
+        '''
+        name = query.get('base', [''])[0]
+        algorithm = query.get('hash', [None])[0]
+        path = self._rom_path(name)
+        if path is None:
+            return 404, b'Unknown base ROM ' + name.encode(), 'text/plain'
+        if algorithm is not None and algorithm not in VERIFY_ALGORITHMS:
+            return 400, b'Unknown hash ' + algorithm.encode(), 'text/plain'
+        if self.pending >= self.max_pending:
+            return 503, b'Too many requests', 'text/plain'
+        self.pending += 1
+        try:
+            patch = await body()
+            async with self.slots:
+                result = await asyncio.get_running_loop().run_in_executor(self.pool, self._apply,
+                    path, patch, query.get('eof', ['0'])[0] == '1', algorithm)
+        except (IpsyError, ValueError) as e:
+            return 400, str(e).encode(), 'text/plain'
+        finally:
+            self.pending -= 1
+        if algorithm:
+            return 200, json.dumps({'base': name, algorithm: result}).encode(), 'application/json'
+        return 200, result, 'application/octet-stream'
+
+    def metrics(self):
+        '''
+        :returns: Metrics in the Prometheus text format
+        '''
+        lines = ['# TYPE ipsy_requests_total counter']
+        lines += ['ipsy_requests_total{path="' + path + '",status="' + str(status) + '"} ' + str(count)
+                  for (path, status), count in sorted(self.responses.items())]
+        lines += ['# TYPE ipsy_request_seconds histogram']
+        for path, histogram in sorted(self.latency.items()):
+            lines += histogram.lines('ipsy_request_seconds', 'path="' + path + '"')
+        cache = self.cache
+        lines += ['# TYPE ipsy_pending_requests gauge', 'ipsy_pending_requests ' + str(self.pending),
+                  '# TYPE ipsy_open_connections gauge', 'ipsy_open_connections ' + str(self.connections),
+                  '# TYPE ipsy_rom_cache_hits_total counter', 'ipsy_rom_cache_hits_total ' + str(cache.hits),
+                  '# TYPE ipsy_rom_cache_misses_total counter', 'ipsy_rom_cache_misses_total ' + str(cache.misses),
+                  '# TYPE ipsy_rom_cache_evictions_total counter',
+                  'ipsy_rom_cache_evictions_total ' + str(cache.evictions),
+                  '# TYPE ipsy_rom_cache_bytes gauge', 'ipsy_rom_cache_bytes ' + str(cache.size)]
+        return '\n'.join(lines) + '\n'
+
+    async def _respond(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/patch':
+            if method != 'POST':
+                return 405, b'Use POST', 'text/plain'
+            return await self._patch(parse_qs(url.query), body)
+        if url.path == '/metrics':
+            return 200, self.metrics().encode(), 'text/plain; version=0.0.4'
+        return 404, b'Not found', 'text/plain'
+
+    async def _send(self, writer, status, data, kind, keep):
+        writer.write(('HTTP/1.1 ' + str(status) + ' ' + _REASONS[status] + '\r\n' +
+            'Content-Type: ' + kind + '\r\nContent-Length: ' + str(len(data)) + '\r\n' +
+            ('' if keep else 'Connection: close\r\n') + '\r\n').encode('latin-1'))
+        writer.write(data)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        '''
+        Serve the requests of one connection, kept alive until the client
+        closes it or asks to.
+        '''
+        if self.connections >= self.max_connections:
+            try:
+                await self._send(writer, 503, b'Too many connections', 'text/plain', False)
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                start = perf_counter()
+                method, target = (line.decode('latin-1').split() + ['', ''])[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                keep = headers.get('connection', '').lower() != 'close'
+                unread = [length]
+                async def body():
+                    unread[0] = 0
+                    return await reader.readexactly(length)
+                if length < 0 or length > SERVER_MAX_BODY:
+                    status, data, kind = (400 if length < 0 else 413), b'Bad body length', 'text/plain'
+                else:
+                    try:
+                        status, data, kind = await self._respond(method, target, body)
+                    except (ConnectionError, asyncio.IncompleteReadError):
+                        raise
+                    except Exception as e:
+                        status, data, kind = 500, (type(e).__name__ + ': ' + str(e)).encode(), 'text/plain'
+                # A body left unread can't be told apart from the next request
+                keep = keep and not unread[0]
+                path = urlsplit(target).path
+                path = path if path in ('/patch', '/metrics') else 'other'
+                await self._send(writer, status, data, kind, keep)
+                self.responses[path, status] = self.responses.get((path, status), 0) + 1
+                self.latency.setdefault(path, _Histogram()).observe(perf_counter() - start)
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000, socket=None):
+        '''
+        Start listening, on a Unix socket if one is given, otherwise on host
+        and port.
+
+        :returns: asyncio Server
+        '''
+        if socket:
+            return await asyncio.start_unix_server(self.handle, socket)
+        return await asyncio.start_server(self.handle, host, port)
+
+def serve( roms_dir, host='127.0.0.1', port=8000, socket=None, **options ):
+    '''
+    Run a :class:`PatchServer` until interrupted.
+
+    :param roms_dir: Directory holding the base ROMs
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param socket: Path of a Unix socket to listen on instead
+    :param options: Passed on to :class:`PatchServer`
+    '''
+    async def run():
+        server = PatchServer(roms_dir, **options)
+        async with await server.start(host, port, socket) as listener:
+            await listener.serve_forever()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from time import perf_counter
+
+__all__ = ['Stats', 'collect_stats', 'current_stats']
+
+_active = ContextVar('ipsy_stats', default=None)
+_OFF = nullcontext()
+
+class Stats:
+    '''
+    Wall time spent in each stage of ipsy and counters of the work done.
+    Stages nest, so the time of 'merge' includes that of the 'diff' run by
+    :func:`cleanup_records`. Collected while :func:`collect_stats` is active.
+
+    Counters are named '<stage>.<what>', e.g. 'read.records' or
+    'rle_compress.saved' (bytes saved by RLE), except 'peak_buffer', the
+    largest single buffer built.
+    '''
+
+    def __init__(self):
+        self.seconds, self.calls, self.counters = {}, {}, {}
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Time a stage.
+
+        :param name: Name of the stage
+        '''
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.time(name, perf_counter() - start)
+
+    def time(self, name, seconds, calls=1):
+        '''
+        Add time to a stage.
+        '''
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def add(self, name, value=1):
+        '''
+        Add to a counter.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        '''
+        Raise a counter to value if it is lower.
+        '''
+        self.counters[name] = max(self.counters.get(name, 0), value)
+
+    def as_dict(self):
+        '''
+        :returns: dict of 'stages', name to seconds and calls, and 'counters'
+        '''
+        return {'stages': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]}
+                           for name in self.seconds},
+                'counters': dict(self.counters)}
+
+    def to_json(self):
+        import json
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def __str__(self):
+        lines = ['{:<16} {:>9.4f}s {:>6} calls'.format(name, self.seconds[name], self.calls[name])
+                 for name in self.seconds]
+        lines += ['{:<24} {:>12}'.format(name, value) for name, value in sorted(self.counters.items())]
+        return '\n'.join(lines)
+
+@contextmanager
+def collect_stats( stats=None ):
+    '''
+    Collect :class:`Stats` for everything run inside the with block, in
+    this thread or task. Work done by other processes, e.g. the workers of
+    :func:`patch_many`, isn't seen.
+
+    :param stats: :class:`Stats` to add to, a new one by default
+    :returns: Context manager yielding the :class:`Stats`
+    '''
+    stats = Stats() if stats is None else stats
+    token = _active.set(stats)
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
+
+def current_stats():
+    '''
+    :returns: The :class:`Stats` being collected, or None
+    '''
+    return _active.get()
+
+def stage( name ):
+    '''
+    Time a stage if stats are being collected, otherwise do nothing.
+    '''
+    stats = _active.get()
+    return _OFF if stats is None else stats.stage(name)
+
+def add( name, value=1 ):
+    stats = _active.get()
+    if stats is not None:
+        stats.add(name, value)
+
+def peak( name, value ):
+    stats = _active.get()
+    if stats is not None:
+        stats.peak(name, value)
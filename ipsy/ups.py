@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from io import UnsupportedOperation
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from zlib import crc32
+from .ipsy import IpsyError, _mapped, _diff_ranges
+from .bps import _number, _chunked_crc
+
+__all__ = ['UPS_MAGIC', 'UpsHeader', 'UpsRecord', 'ups_header', 'iter_ups_records',
+           'ups_patch', 'ups_diff']
+
+UPS_MAGIC = b'UPS1'
+UPS_FOOTER_SIZE = 12      # Input, output and patch CRC32
+UPS_CHUNK_SIZE = 2**20    # Bytes copied, XORed and hashed at a time
+
+_FOOTER = Struct('<III')
+
+class UpsHeader( namedtuple('UpsHeader', 'input_size output_size input_crc output_crc') ):
+    '''
+    Header and footer of a UPS file.
+
+    :param input_size: Size of the unpatched file
+    :param output_size: Size of the patched file
+    :param input_crc: CRC32 of the unpatched file
+    :param output_crc: CRC32 of the patched file
+    '''
+    pass
+
+class UpsRecord( namedtuple('UpsRecord', 'offset xor') ):
+    '''
+    One hunk of a UPS file.
+
+    :param offset: Absolute offset the hunk starts at
+    :param xor: bytes to XOR with the file, none of them 0
+    '''
+    pass
+
+def _patch_bytes( fh ):
+    '''
+    The rest of a patch as something that can be sliced and searched; a
+    read-only memory map when possible, so nothing is copied.
+    '''
+    try:
+        if not fh.tell():
+            return mmap(fh.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, OSError, ValueError, UnsupportedOperation):
+        pass
+    return fh.read()
+
+def _decode( buf, pos ):
+    data, shift = 0, 1
+    while True:
+        if pos >= len(buf):
+            raise IpsyError(
+                "UPS file unexpectedly ended")
+        x = buf[pos]
+        pos += 1
+        data += (x & 0x7f) * shift
+        if x & 0x80:
+            return data, pos
+        shift <<= 7
+        data += shift
+
+def _read_header( buf ):
+    if len(buf) < len(UPS_MAGIC) + 2 + UPS_FOOTER_SIZE:
+        raise IpsyError(
+            "UPS file is too small to be valid")
+    if buf[:len(UPS_MAGIC)] != UPS_MAGIC:
+        raise IpsyError(
+            "UPS file missing header")
+    input_size, pos = _decode( buf, len(UPS_MAGIC) )
+    output_size, pos = _decode( buf, pos )
+    input_crc, output_crc, _ = _FOOTER.unpack(buf[-UPS_FOOTER_SIZE:])
+    return UpsHeader(input_size, output_size, input_crc, output_crc), pos
+
+def ups_header( fhpatch ):
+    '''
+    Read the sizes and checksums of a UPS file.
+
+    :param fhpatch: File handler for UPS patch
+    :returns: :class:`UpsHeader`
+    '''
+    return _read_header( _patch_bytes( fhpatch ) )[0]
+
+def _records( buf, pos ):
+    end, offset = len(buf) - UPS_FOOTER_SIZE, 0
+    while pos < end:
+        skip, pos = _decode( buf, pos )
+        stop = buf.find(b'\x00', pos, end)
+        if stop < 0:
+            raise IpsyError(
+                "UPS file unexpectedly ended")
+        offset += skip
+        yield UpsRecord(offset, buf[pos:stop])
+        offset += stop - pos + 1
+        pos = stop + 1
+
+def iter_ups_records( fhpatch ):
+    '''
+    Lazily read the hunks of a UPS file.
+
+    :param fhpatch: File handler for UPS patch
+    :returns: Generator of :class:`UpsRecord`
+    '''
+    buf = _patch_bytes( fhpatch )
+    yield from _records( buf, _read_header( buf )[1] )
+
+def _xor( data, xor ):
+    return (int.from_bytes(data, byteorder='big') ^
+            int.from_bytes(xor, byteorder='big')).to_bytes(len(xor), byteorder='big')
+
+def _xor_records( fhdest, base, records, size ):
+    '''
+    XOR every record into fhdest, through a memory map when possible.
+
+    :returns: Number of records applied
+    '''
+    count = 0
+    try:
+        fhdest.flush()
+        mm = mmap(fhdest.fileno(), 0)
+    except (AttributeError, OSError, ValueError, UnsupportedOperation):
+        mm = None
+    try:
+        for count, r in enumerate(records, 1):
+            if r.offset + len(r.xor) > size:
+                raise IpsyError(
+                    "UPS hunk is past the end of the file")
+            for i in range(0, len(r.xor), UPS_CHUNK_SIZE):
+                start, xor = base + r.offset + i, r.xor[i:i+UPS_CHUNK_SIZE]
+                if mm is not None:
+                    mm[start:start+len(xor)] = _xor( mm[start:start+len(xor)], xor )
+                else:
+                    fhdest.seek(start)
+                    data = _xor( fhdest.read(len(xor)), xor )
+                    fhdest.seek(start)
+                    fhdest.write(data)
+    finally:
+        if mm is not None:
+            mm.close()
+    return count
+
+def _file_crc( fh, start, size ):
+    fh.seek(start)
+    crc = 0
+    while size:
+        data = fh.read(min(size, UPS_CHUNK_SIZE))
+        if not data:
+            break
+        crc, size = crc32(data, crc), size - len(data)
+    return crc
+
+def ups_patch( fhsrc, fhpatch, fhdest, verify=True ):
+    '''
+    Apply a UPS patch. UPS hunks are XORed with the file, so the same patch
+    turns the unpatched file into the patched one and back again; which way
+    to go is picked by the checksum of fhsrc. Hunks are XORed a block at a
+    time as large integers, in place, through a memory map of fhdest.
+
+    :param fhsrc: File handler of the file to patch (or unpatch)
+    :param fhpatch: File handler of the UPS patch
+    :param fhdest: File handler for the new file, opened 'w+b'
+    :param verify: Check the patch, source and result checksums
+    :returns: Number of hunks applied
+    '''
+    buf = _patch_bytes( fhpatch )
+    header, pos = _read_header( buf )
+    if verify:
+        crc = 0
+        for i in range(0, len(buf) - 4, UPS_CHUNK_SIZE):
+            crc = crc32(buf[i:min(i+UPS_CHUNK_SIZE, len(buf)-4)], crc)
+        if crc != int.from_bytes(buf[-4:], byteorder='little'):
+            raise IpsyError(
+                "UPS patch checksum does not match, the patch is corrupt")
+    base = fhdest.tell()
+    with _mapped( fhsrc ) as source:
+        source_crc = _chunked_crc( source )
+        if source_crc == header.input_crc and len(source) == header.input_size:
+            size, expect = header.output_size, header.output_crc
+        elif source_crc == header.output_crc and len(source) == header.output_size:
+            size, expect = header.input_size, header.input_crc
+        elif verify:
+            raise IpsyError(
+                "Source checksum matches neither side of the UPS patch")
+        else:
+            size, expect = header.output_size, None
+        for i in range(0, len(source), UPS_CHUNK_SIZE):
+            fhdest.write(source[i:i+UPS_CHUNK_SIZE])
+        written = len(source)
+    work = max(header.input_size, header.output_size, written)
+    for i in range(written, work, UPS_CHUNK_SIZE):
+        fhdest.write(bytes(min(UPS_CHUNK_SIZE, work - i)))
+    count = _xor_records( fhdest, base, _records( buf, pos ), work )
+    fhdest.truncate(base + size)
+    if verify and _file_crc( fhdest, base, size ) != expect:
+        raise IpsyError(
+            "Target checksum does not match the UPS patch")
+    fhdest.seek(base + size)
+    return count
+
+def ups_diff( fhsrc, fhdst, fhpatch ):
+    '''
+    Create a UPS patch. The files may differ in size, the shorter one is
+    treated as if padded with zeros.
+
+    :param fhsrc: File handler of the unpatched file
+    :param fhdst: File handler of the patched file
+    :param fhpatch: File handler for the UPS file
+    :returns: Number of hunks in the patch
+    '''
+    source, target = fhsrc.read(), fhdst.read()
+    size = max(len(source), len(target))
+    padded_source = source + bytes(size - len(source))
+    padded_target = target + bytes(size - len(target))
+    body = [UPS_MAGIC, _number( len(source) ), _number( len(target) )]
+    pos = count = 0
+    for start, end in _diff_ranges( padded_source, padded_target ):
+        body += [_number( start - pos ), _xor( padded_source[start:end], padded_target[start:end] ), b'\x00']
+        pos, count = end + 1, count + 1
+    body.append(_FOOTER.pack(crc32(source), crc32(target), 0)[:-4])
+    crc = 0
+    for piece in body:
+        crc = crc32(piece, crc)
+        fhpatch.write(piece)
+    fhpatch.write(crc.to_bytes(4, byteorder='little'))
+    return count
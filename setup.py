@@ -11,6 +11,7 @@ setup(
     license = 'GPLv3',
     url = 'https://gitlab.com/aanunez/ipsy',
     packages = ['ipsy'],
+    python_requires = '>=3.7',
     entry_points={
         'console_scripts': [
             'ipsy = ipsy.__main__:main'
@@ -24,7 +25,14 @@ setup(
         'Intended Audience :: Developers',
         'Topic :: Software Development',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
     keywords='emulation ips rom patch emulator'
 )
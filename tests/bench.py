@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import os, sys, io, json, random, time, platform, tempfile, warnings
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.sep.join(os.path.realpath(__file__).split(os.sep)[:-2]))
+from ipsy import read, write, diff, patch, merge, cleanup_records, rle_compress, \
+    EOF_OFFSET, MAX_UNPATCHED
+
+SIZES = [2**16, 2**20, 2**22, MAX_UNPATCHED]
+
+INVERT = bytes(range(255, -1, -1))
+FLIP = bytes(i ^ 1 for i in range(256))
+
+def sparse(rng, rom):
+    for _ in range(len(rom) // 2**14):
+        i, n = rng.randrange(len(rom) - 16), rng.randint(1, 16)
+        rom[i:i+n] = rng.randbytes(n)
+
+def dense(rng, rom):
+    rom[:len(rom)//2] = rom[:len(rom)//2].translate(INVERT)
+
+def runs(rng, rom):
+    for _ in range(len(rom) // 2**12):
+        i, n = rng.randrange(len(rom)), rng.randint(64, 1024)
+        rom[i:i+n] = bytes([rng.randrange(256)])*len(rom[i:i+n])
+
+def tiny(rng, rom):
+    rom[::64] = rom[::64].translate(FLIP)
+
+def eof_edge(rng, rom):
+    for i in (EOF_OFFSET - 1, EOF_OFFSET, EOF_OFFSET + 2):
+        if i < len(rom):
+            rom[i] ^= 0xff
+    sparse(rng, rom)
+
+PATTERNS = {'sparse': sparse, 'dense': dense, 'runs': runs, 'tiny': tiny, 'eof': eof_edge}
+
+def best(repeat, func, setup=lambda: None):
+    '''
+    Fastest of several runs of func, setup is called untimed before each.
+    '''
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench(tmp, size, pattern, repeat):
+    rng = random.Random(pattern + str(size))
+    rom = rng.randbytes(size//2) + bytes(size - size//2)
+    edited, other = bytearray(rom), bytearray(rom)
+    PATTERNS[pattern](rng, edited)
+    PATTERNS[pattern](rng, other)
+    paths = {}
+    for name, data in (('rom', rom), ('edited', edited), ('other', other)):
+        paths[name] = os.path.join(tmp, name)
+        with open(paths[name], 'wb') as fh:
+            fh.write(data)
+    def do_diff(rle, dst='edited'):
+        with open(paths['rom'], 'rb') as fhsrc, open(paths[dst], 'rb') as fhdst:
+            return diff( fhsrc, fhdst, None, rle )
+    records = do_diff(False)
+    patches = {}
+    for name, dst in (('patch', 'edited'), ('other_patch', 'other')):
+        patches[name] = os.path.join(tmp, name + '.ips')
+        with open(patches[name], 'wb') as fh:
+            write( fh, do_diff(True, dst) )
+    def do_read(_):
+        with open(patches['patch'], 'rb') as fh:
+            read( fh )
+    def do_patch(rom_path):
+        with open(rom_path, 'r+b') as fhdest, open(patches['patch'], 'rb') as fhpatch:
+            patch( fhdest, fhpatch, mapped=True )
+    def fresh_rom():
+        with open(paths['rom'], 'rb') as fhin, open(os.path.join(tmp, 'out'), 'wb') as fhout:
+            fhout.write(fhin.read())
+        return os.path.join(tmp, 'out')
+    def do_merge(_):
+        with open(patches['patch'], 'rb') as fha, open(patches['other_patch'], 'rb') as fhb:
+            merge( io.BytesIO(), fha, fhb )
+    return {
+        'read': best(repeat, do_read),
+        'write': best(repeat, lambda _: write( io.BytesIO(), records )),
+        'diff': best(repeat, lambda _: do_diff(False)),
+        'diff_rle': best(repeat, lambda _: do_diff(True)),
+        'patch': best(repeat, do_patch, fresh_rom),
+        'merge': best(repeat, do_merge),
+        'cleanup_records': best(repeat, lambda _: cleanup_records( records, paths['rom'] )),
+        'rle_compress': best(repeat, lambda _: list(rle_compress( records ))),
+        'records': len(records),
+    }
+
+def compare(results, baseline, threshold, floor):
+    '''
+    Print every timing next to the baseline's.
+
+    :returns: List of names that are slower than the baseline by more than threshold
+    '''
+    slower = []
+    for name, seconds in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        ratio = seconds / base if base else float('inf')
+        flag = ''
+        if ratio > 1 + threshold and seconds > floor:
+            slower.append(name)
+            flag = '  REGRESSION'
+        print('{:<40} {:>9.4f}s {:>9.4f}s {:>6.2f}x{}'.format(name, base, seconds, ratio, flag))
+    return slower
+
+def main():
+    parser = ArgumentParser(description='Time ipsy on synthetic ROMs and compare against a baseline.')
+    parser.add_argument('-o','--output', default='bench.json', help=
+        'JSON file to write the timings to.')
+    parser.add_argument('-baseline', default=None, help=
+        'JSON file from an earlier run to compare against.')
+    parser.add_argument('-threshold', type=float, default=0.25, help=
+        'Fraction slower than the baseline that counts as a regression.')
+    parser.add_argument('-floor', type=float, default=0.005, help=
+        'Timings under this many seconds are never counted as regressions.')
+    parser.add_argument('-sizes', type=int, nargs='+', default=SIZES, help=
+        'ROM sizes, in bytes, to benchmark.')
+    parser.add_argument('-patterns', nargs='+', default=list(PATTERNS), choices=list(PATTERNS), help=
+        'Kinds of change to benchmark.')
+    parser.add_argument('-repeat', type=int, default=3, help=
+        'Runs of each timing, the fastest is kept.')
+    opts = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in opts.sizes:
+            for pattern in opts.patterns:
+                timings = bench(tmp, size, pattern, opts.repeat)
+                print('{:>9} {:<7} {:>8} records  '.format(size, pattern, timings.pop('records')) + \
+                    '  '.join('{} {:.4f}s'.format(name, t) for name, t in timings.items()))
+                for name, seconds in timings.items():
+                    results[name + '/' + str(size) + '/' + pattern] = seconds
+    with open(opts.output, 'w') as fh:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                   'results': results}, fh, indent=1, sort_keys=True)
+    if opts.baseline:
+        with open(opts.baseline) as fh:
+            baseline = json.load(fh)['results']
+        slower = compare(results, baseline, opts.threshold, opts.floor)
+        if slower:
+            print(str(len(slower)) + ' timings regressed by more than ' + \
+                '{:.0%}'.format(opts.threshold) + '.')
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import os, sys, io, random, time
+
+sys.path.insert(0, os.sep.join(os.path.realpath(__file__).split(os.sep)[:-2]))
+from ipsy import diff, bps_diff, bps_patch
+
+def edited(src, edits, shift):
+    tgt = bytearray(src)
+    for _ in range(edits):
+        i = random.randrange(len(tgt) - 256)
+        n = random.randint(1, 200)
+        tgt[i:i+n] = os.urandom(n) if random.random() < 0.5 else bytes([random.randrange(256)])*n
+    if shift:
+        tgt[len(tgt)//3:len(tgt)//3] = os.urandom(shift)
+        del tgt[-shift:]
+    return bytes(tgt)
+
+def run(name, src, tgt):
+    start = time.perf_counter()
+    fhbps = io.BytesIO()
+    bps_diff( io.BytesIO(src), io.BytesIO(tgt), fhbps )
+    bps_time = time.perf_counter() - start
+    fhbps.seek(0)
+    fhout = io.BytesIO()
+    bps_patch( io.BytesIO(src), fhbps, fhout )
+    if fhout.getvalue() != tgt:
+        print('Issue on ' + name + ', BPS round trip differs')
+    start = time.perf_counter()
+    fhips = io.BytesIO()
+    diff( io.BytesIO(src), io.BytesIO(tgt), fhips, rle=True )
+    ips_time = time.perf_counter() - start
+    print('{:<24} BPS {:>10} bytes {:>6.2f}s   IPS {:>10} bytes {:>6.2f}s'.format(
+        name, len(fhbps.getvalue()), bps_time, len(fhips.getvalue()), ips_time))
+
+random.seed(0)
+rom = os.urandom(2**23) + bytes(2**23)
+print("Comparing BPS and IPS patch sizes on 16 MiB files...")
+run('sparse edits', rom, edited(rom, 200, 0))
+run('dense edits', rom, edited(rom, 20000, 0))
+run('inserted 4 KiB', rom, edited(rom, 200, 4096))
+big = rom + os.urandom(2**24)
+start = time.perf_counter()
+bps_diff( io.BytesIO(big), io.BytesIO(edited(big, 2000, 4096)), io.BytesIO() )
+print("BPS diff of a 32 MiB pair took {:.2f}s".format(time.perf_counter() - start))
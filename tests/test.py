@@ -1,23 +1,288 @@
 #!/usr/bin/env python3
-import os, filecmp
+import os, sys, filecmp, shutil, json
 
 os.chdir(os.sep.join(os.path.realpath(__file__).split(os.sep)[:-2]))
+sys.path.insert(0, os.getcwd())
 print("Running tests...")
 
-os.system('python3 -m ipsy -o _output1 diff tests/diff_test/rom tests/diff_test/patched_rom')
+os.system('python3 -m ipsy diff tests/diff_test/rom tests/diff_test/patched_rom -norle -o _output1')
 if not filecmp.cmp('tests/diff_test/output1', '_output1'):
     print('Issue on diff_test w/o rle')
 
-os.system('python3 -m ipsy -o _output2 diff -rle tests/diff_test/rom tests/diff_test/patched_rom')
+os.system('python3 -m ipsy diff tests/diff_test/rom tests/diff_test/patched_rom -o _output2')
 if not filecmp.cmp('tests/diff_test/output2', '_output2'):
     print('Issue on diff_test w/ rle')
 
-os.system('python3 -m ipsy -o _output3 patch tests/patch_test/rom tests/patch_test/patch')
+os.system('python3 -m ipsy diff tests/diff_test/rom tests/diff_test/patched_rom -j 2 -o _output2')
+if not filecmp.cmp('tests/diff_test/output2', '_output2'):
+    print('Issue on parallel diff_test')
+
+shutil.copyfile('tests/diff_test/patched_rom', '_output_rom')
+os.system('python3 -W ignore -m ipsy diff _output_rom tests/diff_test/patched_rom -hashed -o _output2h')
+shutil.copyfile('tests/diff_test/rom', '_output_rom')
+os.utime('_output_rom', ns=(0, 0)) # The hashes saved for the old contents are now stale
+os.system('python3 -m ipsy diff _output_rom tests/diff_test/patched_rom -hashed -o _output2h')
+if not filecmp.cmp('tests/diff_test/output2', '_output2h'):
+    print('Issue on hashed diff_test w/ stale hashes')
+
+os.system('python3 -m ipsy diff _output_rom tests/diff_test/patched_rom -hashed -norle -o _output1h')
+if not filecmp.cmp('tests/diff_test/output1', '_output1h'):
+    print('Issue on hashed diff_test w/ saved hashes')
+
+shutil.rmtree('_output_cache', ignore_errors=True)
+shutil.copyfile('tests/diff_test/patched_rom', '_output_rom')
+for i in range(2):
+    report = os.popen('python3 -m ipsy diff tests/diff_test/rom _output_rom --cache-dir _output_cache ' + \
+                      '-o _output2c').read()
+    if not filecmp.cmp('tests/diff_test/output2', '_output2c') or ('Cache: ' + str(i) + ' hits') not in report:
+        print('Issue on cached diff_test')
+
+with open('_output_rom', 'r+b') as fh:
+    fh.write(b'changed') # The cached result is for the old contents
+os.system('python3 -m ipsy diff tests/diff_test/rom _output_rom -o _output2n')
+report = os.popen('python3 -m ipsy diff tests/diff_test/rom _output_rom --cache-dir _output_cache -o _output2c').read()
+if not filecmp.cmp('_output2n', '_output2c') or 'Cache: 0 hits' not in report:
+    print('Issue on cached diff_test after a change')
+
+for i in range(2):
+    report = os.popen('python3 -m ipsy patch tests/patch_test/rom tests/patch_test/patch ' + \
+                      '--cache-dir _output_cache -o _output3c').read()
+    if not filecmp.cmp('tests/patch_test/output3', '_output3c') or ('Cache: ' + str(i) + ' hits') not in report:
+        print('Issue on cached patch_test')
+
+for pipe in ('_output_pipe1', '_output_pipe2'):
+    if os.path.exists(pipe):
+        os.remove(pipe)
+    os.mkfifo(pipe)
+os.system('cat tests/diff_test/patched_rom > _output_pipe1 & ' + \
+          'cat tests/diff_test/rom | python3 -m ipsy diff /dev/stdin _output_pipe1 -norle -o _output1s')
+if not filecmp.cmp('tests/diff_test/output1', '_output1s'):
+    print('Issue on streamed diff_test w/o rle')
+
+os.system('cat tests/diff_test/patched_rom > _output_pipe2 & ' + \
+          'cat tests/diff_test/rom | python3 -m ipsy diff /dev/stdin _output_pipe2 -o _output2s')
+if not filecmp.cmp('tests/diff_test/output2', '_output2s'):
+    print('Issue on streamed diff_test w/ rle')
+
+# A change longer than a record starting on b'EOF', streamed through windows smaller than a record
+from io import BytesIO
+from ipsy.ipsy import EOF_OFFSET, diff_stream, patch_from_records
+unpatched = bytes(EOF_OFFSET + 200000)
+patched = unpatched[:EOF_OFFSET] + b'\x01'*70000 + unpatched[EOF_OFFSET+70000:]
+for rle in (False, True):
+    fhdest = BytesIO(unpatched)
+    patch_from_records( fhdest, diff_stream( BytesIO(unpatched), BytesIO(patched), rle, window=4096 ) )
+    if fhdest.getvalue() != patched:
+        print('Issue on streamed diff_test at EOF offset ' + ('w/' if rle else 'w/o') + ' rle')
+
+# One RLE record covers two changes when the bytes between them are the same run
+from ipsy.ipsy import encode, diff_stream
+unpatched, patched = b'B'*10 + b'A'*20 + b'B'*10, b'A'*40
+for records in (list(encode( patched, [(0, 10), (30, 40)] )), list(diff_stream( BytesIO(unpatched), BytesIO(patched), True ))):
+    if [(r.offset, r.rle_size) for r in records] != [(0, 40)]:
+        print('Issue on rle across an unchanged run')
+
+# A streamed patch is rewritten as IPS32 once a record needs it, whatever was written before
+from ipsy.ipsy import IPS32_HEADER, MAX_UNPATCHED, IpsRecord, read, write
+records = [IpsRecord(offset, 1, None, b'\x01') for offset in range(0, MAX_UNPATCHED + 2**20, 2**10)]
+fhpatch = BytesIO()
+write( fhpatch, iter(records) )
+if not fhpatch.getvalue().startswith(IPS32_HEADER) or [r.offset for r in read( BytesIO(fhpatch.getvalue()) )] != [r.offset for r in records]:
+    print('Issue on streamed write past 16 MiB')
+
+os.system('python3 -m ipsy patch tests/patch_test/rom tests/patch_test/patch -o _output3')
 if not filecmp.cmp('tests/patch_test/output3', '_output3'):
     print('Issue on patch_test')
 
-os.system('python3 -m ipsy -o _output4 merge tests/merge_test/patch1 tests/merge_test/patch2')
+# Several patches each make their own file, named after the ROM and the patch
+shutil.copyfile('tests/patch_test/rom', '_output11.rom')
+for jobs in ('1', '2'):
+    for output in ('_output11_patch_patched.rom', '_output11_patch1_patched.rom'):
+        if os.path.exists(output):
+            os.remove(output)
+    os.system('python3 -m ipsy patch _output11.rom tests/patch_test/patch tests/merge_test/patch1 -j ' + jobs)
+    if not os.path.exists('_output11_patch_patched.rom') or not os.path.exists('_output11_patch1_patched.rom') or \
+       not filecmp.cmp('tests/patch_test/output3', '_output11_patch_patched.rom') or \
+       not filecmp.cmp('tests/patch_test/output11', '_output11_patch1_patched.rom'):
+        print('Issue on patch_test of several patches with ' + jobs + ' processes')
+
+os.system('python3 -m ipsy patch tests/patch_test/rom tests/ips32_test/patch -o _output3')
+if not filecmp.cmp('tests/patch_test/output3', '_output3'):
+    print('Issue on ips32 patch_test')
+
+os.system('python3 -m ipsy patch tests/patch_test/rom tests/patch_test/patch -u _output3u -o _output3')
+os.system('python3 -m ipsy patch _output3 _output3u -o _output3r')
+if not filecmp.cmp('tests/patch_test/rom', '_output3r'):
+    print('Issue on undo patch_test')
+
+if os.system('python3 -m ipsy verify tests/patch_test/rom tests/patch_test/patch tests/ips32_test/patch ' + \
+             '-hash sha1 -expect 4afedb9db23570e59fccd9e350c7b1feecaf414a 4afedb9db23570e59fccd9e350c7b1feecaf414a'):
+    print('Issue on verify_test')
+
+os.system('python3 -m ipsy merge tests/merge_test/patch1 tests/merge_test/patch2 -o _output4')
 if not filecmp.cmp('tests/merge_test/output4', '_output4'):
     print('Issue on merge_test')
 
+os.system('python3 -m ipsy merge tests/merge_test/patch1 tests/merge_test/patch2 -d tests/patch_test/rom -o _output4d')
+os.system('python3 -m ipsy patch tests/patch_test/rom _output4d -o _output4p')
+os.system('python3 -m ipsy patch tests/patch_test/rom tests/merge_test/patch1 tests/merge_test/patch2 -stack -o _output4s')
+if not filecmp.cmp('_output4s', '_output4p'):
+    print('Issue on merge_test w/ destination')
+
+os.system('python3 -m ipsy conflicts tests/merge_test/patch1 tests/merge_test/patch2 tests/patch_test/patch ' + \
+          '-compare -o _output9')
+if not filecmp.cmp('tests/conflicts_test/output9', '_output9'):
+    print('Issue on conflicts_test')
+
+for stats in ('', ' --stats json 2> _output9s'):
+    report = os.popen('python3 -m ipsy conflicts tests/merge_test/patch1 tests/patch_test/patch' + stats).read()
+    if [(o['first'], o['second']) for o in json.loads(report)] != [('tests/merge_test/patch1', 'tests/patch_test/patch')]*6:
+        print('Issue on conflicts_test printed' + (' w/ stats' if stats else ''))
+with open('_output9s') as fh:
+    if 'stages' not in json.load(fh):
+        print('Issue on conflicts_test stats')
+
+for jobs in ('1', '2'):
+    for output in ('_output10d', '_output10b', '_output10p', '_output10m'):
+        if os.path.exists(output):
+            os.remove(output)
+    if os.system('python3 -m ipsy batch tests/batch_test/manifest -j ' + jobs + ' -o _output10'):
+        print('Issue on batch_test with ' + jobs + ' processes')
+    with open('_output10') as fh:
+        results = {result['id']: result for result in map(json.loads, fh)}
+    if sorted(results) != ['bps', 'diff', 'merge', 'patch'] or any(r['error'] for r in results.values()) or \
+       not filecmp.cmp('tests/diff_test/output2', '_output10d') or \
+       not filecmp.cmp('tests/bps_test/output5', '_output10b') or \
+       not filecmp.cmp('tests/patch_test/output3', '_output10p') or \
+       not filecmp.cmp('tests/merge_test/output4', '_output10m'):
+        print('Issue on batch_test with ' + jobs + ' processes')
+
+# PatchIndex answers as a scan of every record does, whether built, reloaded or rebuilt from its sidecar
+import random
+from ipsy.index import INDEX_SUFFIX, PatchIndex
+from ipsy.ipsy import iter_records
+rng, records = random.Random(0), []
+for _ in range(500):
+    offset = rng.randrange(2**14)
+    if rng.random() < 0.2:
+        records.append(IpsRecord(offset, 0, rng.randint(1, 2**12), bytes([rng.randrange(256)])))
+    else:
+        size = rng.choice((1, 16, 256, 2**12))
+        records.append(IpsRecord(offset, size, 0, bytes(rng.randrange(256) for _ in range(size))))
+with open('_output_index', 'wb') as fh:
+    write( fh, records )
+if os.path.exists('_output_index' + INDEX_SUFFIX):
+    os.remove('_output_index' + INDEX_SUFFIX)
+queries = [(start, start + rng.choice((1, 7, 300, 5000))) for start in (rng.randrange(2**15) for _ in range(200))]
+
+def index_matches( fh, sidecar ):
+    index, scanned = PatchIndex( fh, sidecar=sidecar ), list(iter_records( fh ))
+    fh.seek(0)
+    for start, stop in queries:
+        image = {}
+        for r in scanned:
+            for address in range(max(r.offset, start), min(r.last_byte(), stop)):
+                image[address] = r.data[address - r.offset] if r.size else r.data[0]
+        spans = []
+        for address in sorted(image):
+            if spans and spans[-1][0] + len(spans[-1][1]) == address:
+                spans[-1][1].append(image[address])
+            else:
+                spans.append((address, bytearray([image[address]])))
+        rows = [n for n, r in enumerate(scanned) if r.offset < stop and r.last_byte() > start]
+        if index.rows(start, stop) != rows or [(o, bytes(d)) for o, d in index.writes(start, stop)] != \
+           [(o, bytes(d)) for o, d in spans]:
+            return False
+    return True
+
+with open('_output_index', 'rb') as fh:
+    sidecar = '_output_index' + INDEX_SUFFIX
+    if not index_matches( fh, sidecar ) or not os.path.exists(sidecar):
+        print('Issue on patch index')
+    index = PatchIndex( fh, sidecar=sidecar )
+    if index._load( index._key() ) is None or not index_matches( fh, sidecar ):
+        print('Issue on patch index reloaded from its sidecar')
+    os.utime('_output_index', ns=(0, 0))
+    index = PatchIndex( fh, sidecar=sidecar )
+    if index._load( index._key() ) is not None or not index_matches( fh, sidecar ):
+        print('Issue on patch index w/ a stale sidecar')
+    with open(sidecar, 'r+b') as fhidx:
+        fhidx.truncate(os.path.getsize(sidecar) - 4)
+    index = PatchIndex( fh, sidecar=sidecar )
+    if index._load( index._key() ) is not None or not index_matches( fh, sidecar ):
+        print('Issue on patch index w/ a truncated sidecar')
+
+# The patch server, on a port of its own choosing, in a thread
+import asyncio, hashlib, http.client, socket, threading, time
+from ipsy.server import PatchServer
+
+def start_server( server ):
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(server.start(port=0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return listener.sockets[0].getsockname()[1]
+
+def request( port, method, target, body=None ):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request(method, target, body)
+    response = connection.getresponse()
+    result = response.status, response.read()
+    connection.close()
+    return result
+
+with open('tests/patch_test/patch', 'rb') as fh:
+    patch = fh.read()
+with open('tests/patch_test/output3', 'rb') as fh:
+    patched = fh.read()
+port = start_server( PatchServer('tests/patch_test', workers=1, max_pending=1) )
+if request( port, 'POST', '/patch?base=rom', patch ) != (200, patched):
+    print('Issue on server patch')
+status, data = request( port, 'POST', '/patch?base=rom&hash=sha1', patch )
+if status != 200 or json.loads(data) != {'base': 'rom', 'sha1': hashlib.sha1(patched).hexdigest()}:
+    print('Issue on server patch w/ hash')
+if request( port, 'POST', '/patch?base=../diff_test/rom', patch )[0] != 404:
+    print('Issue on server path traversal')
+if request( port, 'POST', '/patch?base=rom', b'not a patch' )[0] != 400:
+    print('Issue on server malformed patch')
+# A request whose body never comes holds the only pending slot
+held = socket.create_connection(('127.0.0.1', port))
+held.sendall(b'POST /patch?base=rom HTTP/1.1\r\nContent-Length: 10\r\n\r\n')
+for _ in range(100):
+    status, data = request( port, 'GET', '/metrics' )
+    if status != 200 or b'ipsy_pending_requests 1' in data:
+        break
+    time.sleep(0.05)
+if status != 200 or b'ipsy_requests_total{path="/patch",status="200"} 2' not in data:
+    print('Issue on server metrics')
+if request( port, 'POST', '/patch?base=rom', patch )[0] != 503:
+    print('Issue on server backpressure')
+held.close()
+
+os.system('python3 -m ipsy diff tests/diff_test/rom tests/diff_test/patched_rom -bps -o _output5')
+if not filecmp.cmp('tests/bps_test/output5', '_output5'):
+    print('Issue on bps diff_test')
+
+os.system('python3 -m ipsy patch tests/diff_test/rom _output5 -o _output6')
+if not filecmp.cmp('tests/diff_test/patched_rom', '_output6'):
+    print('Issue on bps patch_test')
+
+os.system('python3 -m ipsy diff tests/diff_test/rom tests/diff_test/patched_rom -ups -o _output7')
+if not filecmp.cmp('tests/ups_test/output7', '_output7'):
+    print('Issue on ups diff_test')
+
+os.system('python3 -m ipsy patch tests/diff_test/patched_rom _output7 -o _output8')
+if not filecmp.cmp('tests/diff_test/rom', '_output8'):
+    print('Issue on ups reverse patch_test')
+
+# Unknown names and dir() import no submodule, and every listed name is found where it is listed
+imported = os.popen('python3 -c "import ipsy, sys; hasattr(ipsy, \'nope\'); dir(ipsy); ' + \
+                    'print(sorted(m for m in sys.modules if m.startswith(\'ipsy.\')))"').read()
+import importlib, ipsy
+if imported.strip() != '[]':
+    print('Issue on lazy package imports')
+for module, names in ipsy._EXPORTS.items():
+    module = importlib.import_module('ipsy.' + module)
+    if set(names) != set(getattr(module, '__all__', names)) or not all(hasattr(module, name) for name in names):
+        print('Issue on package exports of ' + module.__name__)
+
 print("Done!")